@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+""" Benchmarks the hot paths of script.py against synthetic CLC-style variant tables.
+    Generates csv files of a range of sizes, times each phase of a count, stats and combined analysis,
+    and writes the timings, throughput and peak memory of each size tier to a json file.
+
+    Usage: python benchmark.py [--tiers small,medium] [--workers 4] [--output benchmark_results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import script
+
+
+DEFAULT_OUT_FILE = 'benchmark_results.json'
+
+# rows per file, columns per file, number of files
+TIERS = (
+    ('small', 1000, 30, 4),
+    ('medium', 50000, 60, 8),
+    ('large', 250000, 200, 8),
+)
+
+VARIANT_TYPES = ('SNV', 'SNV', 'SNV', 'SNV', 'Deletion', 'Insertion', 'MNV', 'Replacement')
+NUCLEOTIDES = 'ACGT'
+
+# the columns of a CLC variant table which the generator knows how to fill
+CLC_COLUMNS = ('Chromosome', 'Region', 'Type', 'Reference', 'Allele', 'Reference allele', 'Length',
+               'Linkage', 'Zygosity', 'Count', 'Coverage', 'Frequency', 'Forward read count',
+               'Reverse read count', 'Forward/reverse balance', 'Average quality', 'Read count',
+               'dbSNP', 'COSMIC', 'Non-synonymous')
+
+
+class VariantTableGenerator(object):
+    """ writes csv files which look like CLC variant exports, named to match script.RE_FILE """
+
+    def __init__(self, rows, cols, seed=0):
+        self.rows = rows
+        self.cols = max(cols, len(CLC_COLUMNS))
+        self.random = random.Random(seed)
+
+        self.headers = list(CLC_COLUMNS)
+        for i in range(self.cols - len(CLC_COLUMNS)):
+            self.headers.append('Annotation {0}'.format(i + 1))
+
+    def write_files(self, path, num_files):
+        filenames = []
+        for num in range(1, num_files + 1):
+            filename = 'benchmark_{0:03d}_g1_variants.csv'.format(num)
+            self.write_file(os.path.join(path, filename))
+            filenames.append(filename)
+        return filenames
+
+    def write_file(self, fn):
+        with open(fn, 'w') as f:
+            f.write(','.join(self.headers) + '\n')
+            for x in range(self.rows):
+                f.write(','.join(self._get_row()) + '\n')
+
+    def _get_row(self):
+        r = self.random
+        variant_type = r.choice(VARIANT_TYPES)
+        coverage = int(r.expovariate(1 / 150.0)) + 1
+        count = r.randint(0, coverage)
+        forward = r.randint(0, count)
+        reference = r.choice(NUCLEOTIDES)
+        allele = r.choice(NUCLEOTIDES)
+        if variant_type == 'Deletion':
+            allele = '-'
+        elif variant_type == 'Insertion':
+            reference = '-'
+
+        row = [str(r.randint(1, 22)),
+               str(r.randint(1, 250000000)),
+               variant_type,
+               reference,
+               allele,
+               r.choice(('Yes', 'No')),
+               '1',
+               r.choice(('', '1', '2')),
+               r.choice(('Homozygous', 'Heterozygous')),
+               str(count),
+               str(coverage),
+               '{0:.2f}'.format(100.0 * count / coverage),
+               str(forward),
+               str(count - forward),
+               '{0:.2f}'.format(r.random()),
+               '{0:.2f}'.format(r.uniform(20, 40)),
+               str(count),
+               r.choice(('', '', '', 'rs{0}'.format(r.randint(1, 10 ** 8)))),
+               r.choice(('', '', '', '', 'COSM{0}'.format(r.randint(1, 10 ** 6)))),
+               r.choice(('Yes', 'No', '-'))]
+
+        # free text annotations, including the occasional quoted field with a comma or line break ...
+        for i in range(self.cols - len(CLC_COLUMNS)):
+            n = r.random()
+            if n < 0.01:
+                row.append('"note, with comma"')
+            elif n < 0.015:
+                row.append('"multi\nline"')
+            else:
+                row.append('{0:.3f}'.format(n))
+        return row
+
+
+class Benchmark(object):
+    """ times each phase of an analysis of one size tier """
+
+    def __init__(self, name, rows, cols, num_files, workers, engine, seed, filter_fn=None):
+        self.name = name
+        self.rows = rows
+        self.cols = cols
+        self.num_files = num_files
+        self.workers = workers
+        self.engine = engine
+        self.seed = seed
+        self.filter_fn = filter_fn
+
+    def run(self, path):
+        generator = VariantTableGenerator(self.rows, self.cols, self.seed)
+
+        started = time.time()
+        generator.write_files(path, self.num_files)
+        generate_time = time.time() - started
+
+        filter_fn = self.filter_fn
+        if filter_fn is None:
+            filter_fn = os.path.join(path, 'filters.csv')
+            with open(filter_fn, 'w') as f:
+                f.write('\n'.join(script.SAMPLE_FILTERS))
+
+        app = script.App()
+
+        # ignore the saved settings of the interactive app, so only the tier and arguments change what is measured ...
+        app.csv_path = path
+        app.filter_file_path = filter_fn
+        app.out_file_path = os.path.join(path, 'results.csv')
+        app.error_log_file_path = os.path.join(path, 'errors.csv')
+        app.workers = self.workers
+        app.chunk_size = script.DEFAULT_CHUNK_SIZE
+        app.prefetch = script.DEFAULT_PREFETCH
+        app.prefetch_memory = script.DEFAULT_PREFETCH_MEMORY
+        app.engine = self.engine
+        app.use_cache = False
+        app.incremental = False
+        app.recursive = False
+        app.case_sensitive = True
+        app.quantile_error = None
+
+        phases = []
+        self._time_phase(phases, '_scan_for_csvs', app._scan_for_csvs)
+        self._time_phase(phases, '_scan_for_filters', app._scan_for_filters)
+        # the analysis phases include writing the results, which are written as each file is analysed ...
+        self._time_phase(phases, '_do_count_analysis', app._do_count_analysis)
+        self._time_phase(phases, '_do_stats_analysis', app._do_stats_analysis)
+        self._time_phase(phases, '_do_combined_analysis', app._do_combined_analysis)
+
+        total_rows = self.rows * self.num_files
+        total_bytes = sum(os.path.getsize(os.path.join(path, f.filename)) for f in app.csv_filenames)
+        for phase in phases:
+            if phase['name'] in ('_do_count_analysis', '_do_stats_analysis', '_do_combined_analysis'):
+                phase['rows_per_sec'] = total_rows / phase['wall_time'] if phase['wall_time'] else None
+                phase['bytes_per_sec'] = total_bytes / phase['wall_time'] if phase['wall_time'] else None
+
+        return {'tier': self.name,
+                'rows_per_file': self.rows,
+                'cols_per_file': self.cols,
+                'files': self.num_files,
+                'total_rows': total_rows,
+                'total_bytes': total_bytes,
+                'filters': len(app.filters),
+                'workers': self.workers,
+                'engine': self.engine,
+                'generate_time': generate_time,
+                'phases': phases,
+                'peak_rss_kb': self._get_peak_rss()}
+
+    def _time_phase(self, phases, name, fn):
+        started = time.time()
+        started_cpu = time.clock()
+        fn()
+        phases.append({'name': name,
+                       'wall_time': time.time() - started,
+                       'cpu_time': time.clock() - started_cpu,
+                       'peak_rss_kb': self._get_peak_rss()})
+
+    def _get_peak_rss(self):
+        """ returns the peak resident set size of this process and its (finished) worker processes, in KB """
+
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform == 'darwin':
+            # reported in bytes on OS X
+            own /= 1024
+            children /= 1024
+        return max(own, children)
+
+
+def _run_benchmark(benchmark, path, queue):
+    """ runs a benchmark in a child process, so peak memory is measured for each tier on its own """
+
+    try:
+        queue.put(benchmark.run(path))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks count and stats analysis of synthetic CLC csv files.')
+    parser.add_argument('--tiers', default='small,medium',
+                        help='comma separated size tiers to run, from: {0} (default: small,medium)'.format(
+                            ', '.join(t[0] for t in TIERS)))
+    parser.add_argument('--rows', type=int, help='override the number of rows per file')
+    parser.add_argument('--cols', type=int, help='override the number of columns per file')
+    parser.add_argument('--files', type=int, help='override the number of files')
+    parser.add_argument('--workers', type=int, default=script.DEFAULT_WORKERS, help='analysis worker processes')
+    parser.add_argument('--engine', default=script.DEFAULT_ENGINE,
+                        choices=(script.ENGINE_COLUMNAR, script.ENGINE_STREAMING), help='analysis engine')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the generated data')
+    parser.add_argument('--filter-file', help='filters csv to analyse with (default: the sample filters)')
+    parser.add_argument('--output', default=DEFAULT_OUT_FILE, help='json file to write the report to')
+    parser.add_argument('--data-dir', help='generate the csv files here (and keep them) rather than in a temp dir')
+    args = parser.parse_args(argv)
+
+    tiers = dict((t[0], t[1:]) for t in TIERS)
+    names = [name.strip() for name in args.tiers.split(',') if name.strip()]
+    for name in names:
+        if name not in tiers:
+            parser.error('unknown tier "{0}"'.format(name))
+
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(),
+              'tiers': []}
+
+    for name in names:
+        rows, cols, num_files = tiers[name]
+        benchmark = Benchmark(name, args.rows or rows, args.cols or cols, args.files or num_files,
+                              args.workers, args.engine, args.seed,
+                              os.path.abspath(args.filter_file) if args.filter_file else None)
+
+        if args.data_dir:
+            path = os.path.join(args.data_dir, name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        else:
+            path = tempfile.mkdtemp(prefix='csv-benchmark-')
+
+        print 'Running {0} tier: {1} files x {2} rows x {3} columns ...'.format(
+            name, benchmark.num_files, benchmark.rows, benchmark.cols)
+        try:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=_run_benchmark, args=(benchmark, path, queue))
+            p.start()
+            tier_report = queue.get()
+            p.join()
+        finally:
+            if not args.data_dir:
+                shutil.rmtree(path, ignore_errors=True)
+
+        if 'error' in tier_report:
+            print tier_report['error']
+            return 1
+
+        for phase in tier_report['phases']:
+            rate = ''
+            if phase.get('rows_per_sec'):
+                rate = '  {0:,.0f} rows/sec'.format(phase['rows_per_sec'])
+            print '  {0:<24}{1:>9.3f}s{2}'.format(phase['name'], phase['wall_time'], rate)
+        print '  peak RSS {0:,} KB'.format(tier_report['peak_rss_kb'])
+
+        report['tiers'].append(tier_report)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print '\nReport saved to {0}'.format(args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
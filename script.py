@@ -5,105 +5,2471 @@
     To set filters, edit the FILTERS dict below.
 """
 
-import StringIO
+import BaseHTTPServer
+import SocketServer
+import argparse
+import array
+import collections
+import copy
+import cProfile
+import cStringIO
+import contextlib
 import csv
 import datetime
+import functools
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import operator
 import os
 import re
+import shutil
+import stat
+import sys
+import tempfile
+import threading
 import time
+import traceback
 
 import numpy as np
 
+try:
+    import resource
+except ImportError:
+    # not available on windows - peak memory is not reported
+    resource = None
+
 
 # the max field size limit defaults to 131072 bytes (2**17).
 # increase to 32 bits to accommodate for large csv files ...
 csv.field_size_limit(2**32)
 
-APP_NAME = 'CSV Counting & Analysis Tool'
+APP_NAME = 'CSV Counting & Analysis Tool'
+
+DEFAULT_IN_DIR = 'unfiltered_CLC_data'
+DEFAULT_OUT_FILE = 'results.csv'
+DEFAULT_ERROR_FILE = 'errors.csv'
+DEFAULT_FILTER_FILE = 'filters.csv'
+DEFAULT_SAMPLE_FILTER_FILE = 'filters_SAMPLE.csv'
+DEFAULT_WORKERS = 1
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024  # files larger than this are split across workers
+DEFAULT_CACHE_DIR = '.csv-filter-analysis-cache'
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+CACHE_TMP_SUFFIX = '.tmp'  # stores (and their files) are written under temporary names, then renamed into place
+CACHE_TMP_MAX_AGE = 60 * 60  # seconds before an abandoned temporary store is evicted from the cache
+DEFAULT_COLUMNAR_DIR = 'columnar'  # sub folder of the CSV Input Directory holding converted csv files
+DEFAULT_PREFETCH = 2  # the number of csv files read ahead of their analysis
+DEFAULT_PREFETCH_MEMORY = 16 * 1024 * 1024  # the most memory held by the blocks of csv files read ahead
+PREFETCH_BLOCK_SIZE = 1024 * 1024  # csv files are read ahead in blocks of this many bytes
+DEFAULT_SERVER_PORT = 8765
+DEFAULT_SERVER_MEMORY = 1024 * 1024 * 1024  # the most memory the analysis server keeps parsed csv files in
+DEFAULT_SERVER_RESULTS = 256  # the number of recent results (and filters) the analysis server keeps
+DEFAULT_WATCH_INTERVAL = 10  # seconds between checks for new or changed csv files in watch mode
+DEFAULT_WATCH_SETTLE_TIME = 60  # seconds a csv file must go unchanged before it is analysed in watch mode
+
+GZIP_SUFFIX = '.gz'  # csv files with this suffix are decompressed as they are read
+
+STATS_OUT_FILE_SUFFIX = '_stats'  # added to the Results Output File name for the stats of a combined analysis
+
+INCREMENTAL_STATE_SUFFIX = '.state.json'  # saved alongside the Results Output File in incremental mode
+INCREMENTAL_STATE_VERSION = 2  # state saved in an older format is discarded
+
+MAX_ERROR_SAMPLES = 10  # the number of example cells listed for each error in the error log
+
+MAX_DICTIONARY_SIZE = 1024  # numeric columns with more distinct values are not dictionary encoded when converted
+MAX_BITMAP_VALUES = 256  # string columns with more distinct values are not bitmap indexed
+QUOTE_SCAN_BLOCK_SIZE = 8 * 1024 * 1024  # the quotes of a file being split are counted in blocks of this size
+DEFAULT_QUANTILE_ERROR = 0.01  # the rank error of quantiles in approximate stats mode
+STATS_BATCH_SIZE = 8192  # the streaming engine adds matched values to approximate stats in batches of this size
+MIN_QUOTED_LINES = 1000  # once this many lines have quotes, a file mostly of quoted lines is read by the csv module
+ORDER_SAMPLE_ROWS = 1000  # the streaming engine measures how often each condition passes on this many rows ...
+ORDER_SAMPLE_INTERVAL = 100000  # ... at the start of each block of this many rows, to order the conditions
+SORTED_INDEX_FRACTION = 16  # a sorted index is used for ranges within 1/16th of the rows of either end of a column
+
+SUPPORTED_OPERATORS = ('=', '<', '<=', '>', '>=')
+
+NUMERIC_OPERATORS = {'<': operator.lt,
+                     '<=': operator.le,
+                     '>': operator.gt,
+                     '>=': operator.ge}
+
+RE_FILE = re.compile('^.*_([0-9]{3})_g1_.*\.csv(\.gz)?$')
+RE_FILTER = '([=><]+)(.*)'
+
+CSV_PATTERN = '_123_g1_'
+
+ACTION_PRINT_CSVS = 1
+ACTION_PRINT_FILTERS = 2
+ACTION_RESCAN_CSVS = 3
+ACTION_RESCAN_FILTERS = 4
+ACTION_GENERATE_SAMPLE_FILTERS = 5
+ACTION_DO_COUNT_ANALYSIS = 6
+ACTION_DO_STATS_ANALYSIS = 7
+ACTION_SETTINGS = 8
+ACTION_CONVERT_CSVS = 9
+ACTION_DO_COMBINED_ANALYSIS = 10
+ACTION_EXIT = 11
+
+ACTION_SETTING_EDIT_CASE_SENSITIVITY = 1
+ACTION_SETTING_EDIT_CSV_PATH = 2
+ACTION_SETTING_EDIT_FILTER_PATH = 3
+ACTION_SETTING_EDIT_OUT_PATH = 4
+ACTION_SETTING_EDIT_WORKERS = 5
+ACTION_SETTING_EDIT_ENGINE = 6
+ACTION_SETTING_EDIT_CACHE = 7
+ACTION_SETTING_EDIT_INCREMENTAL = 8
+ACTION_SETTING_EDIT_APPROXIMATE_STATS = 9
+ACTION_SETTING_RESTORE_DEFAULTS = 10
+
+ANALYSIS_TYPE_COUNT = 'count'
+ANALYSIS_TYPE_STATS = 'stats'
+ANALYSIS_TYPE_COMBINED = 'combined'  # count and stats from one pass, written to separate files
+
+BATCH_ACTION_CONVERT = 'convert'
+BATCH_ACTION_SERVE = 'serve'
+
+EXIT_OK = 0
+EXIT_ANALYSIS_ERRORS = 1  # the analysis completed, but errors were logged
+EXIT_USAGE = 2  # invalid command line arguments (argparse exits with this)
+EXIT_INPUT_ERROR = 3  # the csv files or filters could not be loaded
+EXIT_OUTPUT_ERROR = 4  # the results or errors could not be written
+EXIT_INTERNAL_ERROR = 5  # the run failed with an unexpected exception
+
+ENGINE_COLUMNAR = 'columnar'  # loads the columns needed into numpy arrays, and filters them as masks
+ENGINE_STREAMING = 'streaming'  # evaluates rows one at a time, so memory use does not grow with file size
+
+DEFAULT_ENGINE = ENGINE_COLUMNAR
+
+MISSING_FIELD_MESSAGE = 'Field "{0}" not found - filters using it have been skipped for this file'
+INVALID_DATA_MESSAGE = 'Invalid data - greater/less than queries can only be performed on numeric data'
+RAGGED_ROW_MESSAGE = 'Row has fewer fields than the header - it has been skipped'
+
+# the error group of the rows with fewer fields than the header, which every filter skips - see AnalysisResult ...
+RAGGED_ROW_KEY = ('', None, RAGGED_ROW_MESSAGE)
+
+NAN = float('nan')
+
+# the number of bits set in each byte value, for counting the rows in a packed bitmap ...
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+ERROR_LOG_HEADER = ('File', 'Column', 'Error', 'Count', 'Sample cells')
+
+QUOTE_BYTE = ord('"')
+FIELD_START_BYTES = np.array([ord(c) for c in ",\r\n"], dtype=np.uint8)  # the bytes a field starts after
+
+STATS_FORMULAS = ('Count', 'Mean', 'Standard deviation', 'Min', '25% Quantile', '50% Quantile', '75% Quantile', 'Max')
+STATS_FIELDS = ('Frequency', 'Read count', 'Coverage')
+
+SAMPLE_FILTERS = (
+    'Count,>= 10,>=100',
+    'Coverage,>=10,>=100',
+    'Forward read count,>=5,>=50',
+    'Reverse read count,>=5,>=50',
+    'dbSNP,BLANK,BLANK',
+    'Type,"Deletion,Insertion,MNV,Replacement","Deletion,MNV"',
+    'Frequency,>=2.5,IGNORE',
+    'Non-synonymous,"Yes,No,-","Yes,-"',
+    'COSMIC,BLANK,IGNORE')
+
+
+class AnalysisException(Exception):
+    def __init__(self, message, col_num=None):
+        self.message = message
+        self.col_num = col_num
+
+
+class DuplicateCsvNumException(Exception):
+    def __init__(self, num, fn1, fn2):
+        self.num = num
+        self.fn1 = fn1
+        self.fn2 = fn2
+
+
+class InvalidFilterOperatorException(Exception):
+    def __init__(self, cell, condition):
+        self.cell = cell
+        self.condition = condition
+
+
+class InvalidFilterValueException(Exception):
+    def __init__(self, cell, condition):
+        self.cell = cell
+        self.condition = condition
+
+
+class InvalidJobException(Exception):
+    def __init__(self, message, status=400):
+        self.message = message
+        self.status = status
+
+
+class CsvFile(object):
+    def __init__(self, num, filename):
+        self.num = num
+        self.filename = filename
+
+        self.num_str = '{0:03d}'.format(num)
+
+
+def get_content_hash(fn):
+    """ returns the sha1 hex digest of the contents of a file """
+
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def open_csv(fn):
+    """ opens a csv file for reading with universal newlines (like 'rU' mode), decompressing it if it is gzipped """
+
+    if fn.endswith(GZIP_SUFFIX):
+        return contextlib.closing(_GzipLines(fn))
+    return open(fn, 'rU')
+
+
+def read_csv_data(fn, start=None, end=None):
+    """ returns the contents of a csv file, or of the bytes from start to end of it, with the same newline
+        handling as open_csv. gzipped files are decompressed, and always read whole.
+    """
+
+    if fn.endswith(GZIP_SUFFIX):
+        with contextlib.closing(gzip.open(fn, 'rb')) as f:
+            data = f.read()
+    else:
+        with open(fn, 'rb') as f:
+            if start is None:
+                data = f.read()
+            else:
+                f.seek(start)
+                data = f.read(end - start)
+
+    return data.replace('\r\n', '\n').replace('\r', '\n')
+
+
+class _GzipLines(object):
+    """ iterates over the lines of a gzipped file, with the same newline handling as 'rU' mode """
+
+    def __init__(self, fn):
+        self.f = gzip.open(fn, 'rb')
+
+    def __iter__(self):
+        for line in self.f:
+            if '\r' in line:
+                for l in line.replace('\r\n', '\n').replace('\r', '\n').splitlines(True):
+                    yield l
+            else:
+                yield line
+
+    def close(self):
+        self.f.close()
+
+
+class ProjectingReader(object):
+    """ reads the rows of a csv file like csv.reader with the csv.excel dialect, but once project() is called,
+        only splits each row up to the last of the columns needed - so the fields after it are never allocated.
+        the rows then hold the projected columns (and those before them), followed by the unsplit rest of the line.
+        lines without quotes are split with str.split, and lines with quotes fall back to the csv module,
+        which also reads the following lines of quoted fields spanning several lines. if most lines have quotes,
+        the rest of the file is read by the csv module alone.
+        once project() is given the width of the header, rows with fewer fields are read as None, and their
+        (row index, number of fields) recorded in ragged_rows.
+        the lines must have universal newlines, as returned by open_csv or read_csv_data.
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.maxsplit = -1
+        self.width = 0
+        self.ragged_rows = []
+        self.quoted_line = None
+        self.reader = csv.reader(self._get_quoted_lines(), delimiter=',', dialect=csv.excel)
+
+    def project(self, col_nums, width=0):
+        """ only splits the rows read from now on up to the last of col_nums, and reads the rows with fewer than
+            width fields as None. the indexes in ragged_rows count the rows read from now on.
+        """
+
+        self.maxsplit = max(col_nums) + 1 if col_nums else 0
+        self.width = width
+
+    def __iter__(self):
+        return self._read_rows(self.maxsplit, self.width)
+
+    def next(self):
+        return next(iter(self))
+
+    def _read_rows(self, maxsplit, width):
+        reader = self.reader
+        ragged_rows = self.ragged_rows
+        quoted = 0
+        # the lines of quoted fields spanning several lines are read by the csv module, so x counts rows ...
+        for x, line in enumerate(self.lines):
+            if '"' not in line:
+                line = line.rstrip('\n')
+                if line and line.count(',') >= width - 1:
+                    yield line.split(',', maxsplit)
+                elif width:
+                    ragged_rows.append((x, line.count(',') + 1 if line else 0))
+                    yield None
+                else:
+                    yield []
+                continue
+
+            self.quoted_line = line
+            row = next(reader)
+            if len(row) >= width:
+                yield row
+            else:
+                ragged_rows.append((x, len(row)))
+                yield None
+
+            quoted += 1
+            if quoted >= MIN_QUOTED_LINES and quoted * 2 > x:
+                # handing each line over to the csv module costs more than splitting saves ...
+                for x, row in enumerate(csv.reader(self.lines, delimiter=',', dialect=csv.excel), x + 1):
+                    if len(row) >= width:
+                        yield row
+                    else:
+                        ragged_rows.append((x, len(row)))
+                        yield None
+                return
+
+    def _get_quoted_lines(self):
+        """ yields the line with quotes which is being read, and then any further lines the csv module asks for """
+
+        while True:
+            if self.quoted_line is not None:
+                line, self.quoted_line = self.quoted_line, None
+                yield line
+            else:
+                yield next(self.lines)
+
+
+class CompiledCondition(object):
+    """ a single filter condition, bound to the column layout of one csv file. conditions are evaluated
+        against rows by a FilterEvaluator, and against columns by CsvAnalyser._get_condition_mask.
+    """
+
+    def __init__(self, field, op, vals, col_num, case_sensitive=True):
+        self.field = field
+        self.op = op
+        self.col_num = col_num
+        self.case_sensitive = case_sensitive
+
+        # = conditions test membership of a set of strings (an OR list), which are lower case when
+        # the condition is case insensitive. all other operators compare against a single numeric threshold ...
+        self.vals = None
+        if op == '=':
+            self.vals = frozenset(vals if case_sensitive else [val.lower() for val in vals])
+        self.threshold = float(vals[0]) if op != '=' else None
+        self.compare = NUMERIC_OPERATORS.get(op)
+
+        # identical conditions in different filters share the same key ...
+        self.key = (field, op, self.vals if op == '=' else self.threshold)
+
+
+class CompiledFilter(object):
+    """ a filter (a list of conditions which must all be met) compiled against the headers of one csv file.
+        column indexes are resolved once per file rather than once per row.
+    """
+
+    def __init__(self, conditions, headers, case_sensitive=True):
+        self.conditions = []
+        self.missing_fields = []
+
+        for c in conditions:
+            col_num = None
+            if c['field'] in headers:
+                col_num = headers.index(c['field'])
+            else:
+                self.missing_fields.append(c['field'])
+            self.conditions.append(CompiledCondition(c['field'], c['op'], c['vals'], col_num, case_sensitive))
+
+
+class RowDecoder(object):
+    """ parses the numeric columns of a row once, however many conditions (and stats) use each column.
+        values which are not numeric are recorded in a bitmap of failures, rather than raising.
+        the string columns compared by case insensitive conditions are lower cased once, in place.
+    """
+
+    def __init__(self, col_nums, fold_cols=()):
+        self.col_nums = sorted(set(col_nums))
+        self.indexes = dict((col_num, i) for i, col_num in enumerate(self.col_nums))
+        self.fold_cols = sorted(set(fold_cols))
+
+        self.get_vals = None
+        if len(self.col_nums) == 1:
+            col_num = self.col_nums[0]
+            self.get_vals = lambda row: (row[col_num],)
+        elif self.col_nums:
+            self.get_vals = operator.itemgetter(*self.col_nums)
+
+    def decode(self, row):
+        """ returns a tuple of (values, failures), where values has the float value of each of col_nums in order
+            (NaN if it is not numeric), and bit i of failures is set if the value of col_nums[i] is not numeric
+        """
+
+        for col_num in self.fold_cols:
+            row[col_num] = row[col_num].lower()
+
+        if self.get_vals is None:
+            return [], 0
+
+        vals = self.get_vals(row)
+        try:
+            # fast path - every value is numeric ...
+            return map(float, vals), 0
+        except ValueError:
+            pass
+
+        values = []
+        failures = 0
+        for i, val in enumerate(vals):
+            try:
+                values.append(float(val))
+            except ValueError:
+                values.append(NAN)
+                failures |= 1 << i
+        return values, failures
+
+
+class FilterEvaluator(object):
+    """ evaluates all the compiled filters for a csv file against a row in a single pass.
+        conditions which appear in more than one filter are only evaluated once per row,
+        and the numeric values they compare are decoded by a RowDecoder beforehand.
+
+        the conditions of each filter are evaluated in order of how often they pass, most selective first, so a row
+        fails a filter after as few conditions as possible. how often each condition passes is measured by evaluating
+        every condition against a sample of ORDER_SAMPLE_ROWS rows in each ORDER_SAMPLE_INTERVAL rows.
+        the outcomes are identical to evaluating the conditions in filter order: the order only changes for rows
+        with valid numeric values for all the conditions of the filter, which can only pass or fail.
+    """
+
+    def __init__(self, compiled_filters, decoder):
+        self.conditions = []
+        self.filters = []
+
+        cond_ids = {}
+        for f in compiled_filters:
+            ids = []
+            for c in f.conditions:
+                if c.key not in cond_ids:
+                    cond_ids[c.key] = len(self.conditions)
+                    self.conditions.append(c)
+                ids.append(cond_ids[c.key])
+            self.filters.append(ids)
+
+        # the index of the value of each numeric condition in the decoded values, or None for = conditions ...
+        self.value_indexes = [decoder.indexes[c.col_num] if c.compare is not None else None
+                              for c in self.conditions]
+
+        # a bitmap of the decoded values used by each filter, so rows with invalid data are evaluated in filter order ...
+        self.failure_masks = []
+        for ids in self.filters:
+            mask = 0
+            for i in ids:
+                if self.value_indexes[i] is not None:
+                    mask |= 1 << self.value_indexes[i]
+            self.failure_masks.append(mask)
+
+        self.orders = self.filters
+        self.passes = [0] * len(self.conditions)
+        self.evaluated = [0] * len(self.conditions)
+        self.row_num = -1
+
+    def evaluate(self, row, values, failures):
+        """ returns a list with an outcome for each filter. the outcome is True if the row matches the filter,
+            False if it does not, or an AnalysisException if it has invalid data.
+            values and failures are the numeric values of the row, as returned by RowDecoder.decode
+        """
+
+        self.row_num += 1
+        if self.row_num % ORDER_SAMPLE_INTERVAL < ORDER_SAMPLE_ROWS:
+            return self._sample(row, values, failures)
+
+        outcomes = [None] * len(self.conditions)
+        matches = []
+        for ids, order, mask in itertools.izip(self.filters, self.orders, self.failure_masks):
+            if not failures & mask:
+                ids = order
+
+            match = True
+            for i in ids:
+                outcome = outcomes[i]
+                if outcome is None:
+                    c = self.conditions[i]
+                    j = self.value_indexes[i]
+                    if j is None:
+                        outcome = row[c.col_num] in c.vals
+                    elif failures >> j & 1:
+                        outcome = AnalysisException(INVALID_DATA_MESSAGE, c.col_num)
+                    else:
+                        outcome = c.compare(values[j], c.threshold)
+                    outcomes[i] = outcome
+
+                if outcome is not True:
+                    match = outcome
+                    break
+            matches.append(match)
+        return matches
+
+    def _sample(self, row, values, failures):
+        """ evaluates every condition against a row, counting how often each passes, and returns the outcomes
+            as evaluate() does. the conditions are reordered at the end of each sample.
+        """
+
+        outcomes = []
+        for i, c in enumerate(self.conditions):
+            j = self.value_indexes[i]
+            if j is None:
+                outcome = row[c.col_num] in c.vals
+            elif failures >> j & 1:
+                outcomes.append(AnalysisException(INVALID_DATA_MESSAGE, c.col_num))
+                continue
+            else:
+                outcome = c.compare(values[j], c.threshold)
+
+            self.evaluated[i] += 1
+            if outcome:
+                self.passes[i] += 1
+            outcomes.append(outcome)
+
+        matches = []
+        for ids in self.filters:
+            match = True
+            for i in ids:
+                if outcomes[i] is not True:
+                    match = outcomes[i]
+                    break
+            matches.append(match)
+
+        if self.row_num % ORDER_SAMPLE_INTERVAL == ORDER_SAMPLE_ROWS - 1:
+            self._order_conditions()
+        return matches
+
+    def _order_conditions(self):
+        """ orders the conditions of each filter by how often they have passed, least often first.
+            (the numeric values are decoded before the conditions are evaluated, so every condition
+            costs about the same - a set lookup or a float comparison) ...
+        """
+
+        pass_rates = [float(passes) / evaluated if evaluated else 1.0
+                      for passes, evaluated in zip(self.passes, self.evaluated)]
+        self.orders = [sorted(ids, key=lambda i: pass_rates[i]) for ids in self.filters]
+
+
+class ColumnTable(object):
+    """ the columns of a csv file needed for an analysis, loaded into typed numpy arrays.
+
+        numeric columns are float64 arrays (NaN where a value is not numeric) with a boolean mask of
+        the values which were not numeric, and a {row index: value} dict of the original invalid strings.
+        string columns are dictionary encoded as an array of codes into an array of distinct values.
+        low cardinality string columns are also bitmap indexed, with a packed bitmap (see np.packbits) of the rows
+        holding each distinct value, built the first time the value is used - see isin.
+        numeric columns can have a sorted index, of the row indexes in value order and the sorted values,
+        so a range condition matching few (or nearly all) rows is a binary search - see get_range.
+        rows with fewer fields than the header have blank values, and are listed in ragged_rows, as an array
+        of (row index, number of fields) pairs, so the analysis can skip them.
+    """
+
+    def __init__(self, headers, row_count):
+        self.headers = headers
+        self.row_count = row_count
+        self.ragged_rows = np.empty((0, 2), dtype=np.int64)
+
+        self.numeric = {}  # col_num: (values, invalid, invalid_vals)
+        self.strings = {}  # col_num: (codes, distinct_vals)
+        self.bitmaps = {}  # (col_num, code): packed bitmap
+        self.sorted_indexes = {}  # col_num: (order, sorted_values)
+        self.distinct_nbytes = {}  # col_num: size of the distinct values of a string column - see get_nbytes
+
+    @classmethod
+    def load(cls, headers, reader, numeric_cols, string_cols):
+        """ reads the given numeric and string columns from a ProjectingReader positioned after the header row,
+            which reads rows with fewer fields than the header as None - see ProjectingReader.project
+        """
+
+        col_nums = sorted(set(numeric_cols) | set(string_cols))
+        if not col_nums:
+            table = cls(headers, sum(1 for row in reader))
+            table.ragged_rows = np.array(reader.ragged_rows, dtype=np.int64).reshape(-1, 2)
+            return table
+
+        get_cols = operator.itemgetter(*col_nums)
+        blank = get_cols([''] * (col_nums[-1] + 1))
+        rows = [get_cols(row) if row is not None else blank for row in reader]
+
+        table = cls(headers, len(rows))
+        table.ragged_rows = np.array(reader.ragged_rows, dtype=np.int64).reshape(-1, 2)
+
+        if len(col_nums) == 1:
+            columns = [rows]
+        else:
+            columns = zip(*rows) if rows else [()] * len(col_nums)
+        del rows
+
+        for col_num, col in zip(col_nums, columns):
+            if col_num in numeric_cols:
+                table.numeric[col_num] = cls.parse_numeric(col)
+            if col_num in string_cols:
+                distinct_vals, codes = np.unique(np.array(col, dtype=object), return_inverse=True)
+                table.strings[col_num] = (codes, distinct_vals)
+
+        return table
+
+    @staticmethod
+    def parse_numeric(col):
+        """ converts a column of strings to a tuple of (values, invalid, invalid_vals) - see ColumnTable """
+
+        try:
+            # fast path - every value is numeric ...
+            values = np.array(col, dtype=np.float64)
+            return values, np.zeros(len(values), dtype=bool), {}
+        except ValueError:
+            pass
+
+        values = np.empty(len(col), dtype=np.float64)
+        invalid = np.zeros(len(col), dtype=bool)
+        invalid_vals = {}
+        for x, val in enumerate(col):
+            try:
+                values[x] = float(val)
+            except ValueError:
+                values[x] = np.nan
+                invalid[x] = True
+                invalid_vals[x] = val
+        return values, invalid, invalid_vals
+
+    def get_nbytes(self):
+        """ returns the size of the loaded columns, and the bitmaps and sorted indexes built for them, in bytes """
+
+        nbytes = sum(values.nbytes + invalid.nbytes for values, invalid, invalid_vals in self.numeric.values())
+        for col_num, (codes, distinct_vals) in self.strings.items():
+            if col_num not in self.distinct_nbytes:
+                self.distinct_nbytes[col_num] = distinct_vals.nbytes + sum(sys.getsizeof(val) for val in distinct_vals)
+            nbytes += codes.nbytes + self.distinct_nbytes[col_num]
+        nbytes += sum(bitmap.nbytes for bitmap in self.bitmaps.values())
+        nbytes += sum(order.nbytes + sorted_values.nbytes for order, sorted_values in self.sorted_indexes.values())
+        return nbytes + self.ragged_rows.nbytes
+
+    def has_columns(self, numeric_cols, string_cols):
+        return set(numeric_cols) <= set(self.numeric) and set(string_cols) <= set(self.strings)
+
+    def combine(self, other):
+        """ returns a new ColumnTable with the columns and indexes of this table and another table of the same file """
+
+        table = ColumnTable(self.headers, self.row_count)
+        table.ragged_rows = self.ragged_rows
+        for name in ('numeric', 'strings', 'bitmaps', 'sorted_indexes', 'distinct_nbytes'):
+            getattr(table, name).update(getattr(self, name))
+            getattr(table, name).update(getattr(other, name))
+        return table
+
+    def isin(self, col_num, vals, case_sensitive=True):
+        """ returns a packed bitmap of the rows where the column value is one of vals - the OR of the bitmaps
+            of the matching distinct values. when not case sensitive, vals must be lower case.
+        """
+
+        codes, distinct_vals = self.strings[col_num]
+        if case_sensitive:
+            matching_codes = [code for code, val in enumerate(distinct_vals) if val in vals]
+        else:
+            matching_codes = [code for code, val in enumerate(distinct_vals) if val.lower() in vals]
+
+        if len(distinct_vals) > MAX_BITMAP_VALUES:
+            return np.packbits(np.in1d(codes, matching_codes))
+
+        bitmap = np.zeros((self.row_count + 7) // 8, dtype=np.uint8)
+        for code in matching_codes:
+            bitmap |= self.get_bitmap(col_num, code)
+        return bitmap
+
+    def get_range(self, col_num, op, threshold):
+        """ returns a packed bitmap of the rows where the value of a numeric column compares to the threshold
+            with one of the NUMERIC_OPERATORS, found by a binary search of the sorted index of the column.
+            as with the operators, NaN values (which includes invalid data) never match.
+            setting each row is slower than comparing every row unless few rows are inside (or outside) the range,
+            so None is returned if the column has no sorted index, or more than 1/SORTED_INDEX_FRACTION of the
+            rows are both inside and outside the range.
+        """
+
+        if col_num not in self.sorted_indexes or threshold != threshold:
+            return None
+
+        order, sorted_values = self.sorted_indexes[col_num]
+
+        # the matching rows are a contiguous range of the sorted index, with NaN values sorted last ...
+        if op == '<' or op == '<=':
+            start = 0
+            end = np.searchsorted(sorted_values, threshold, 'left' if op == '<' else 'right')
+        else:
+            start = np.searchsorted(sorted_values, threshold, 'right' if op == '>' else 'left')
+            end = np.searchsorted(sorted_values, NAN)
+
+        # set whichever of the rows inside or outside the range are fewer ...
+        limit = self.row_count // SORTED_INDEX_FRACTION
+        if end - start <= limit:
+            mask = np.zeros(self.row_count, dtype=bool)
+            mask[order[start:end]] = True
+        elif self.row_count - (end - start) <= limit:
+            mask = np.ones(self.row_count, dtype=bool)
+            mask[order[:start]] = False
+            mask[order[end:]] = False
+        else:
+            return None
+        return np.packbits(mask)
+
+    def is_narrow_range(self, count):
+        """ returns True if a range matching count rows would be found quicker with a sorted index - see get_range """
+
+        limit = self.row_count // SORTED_INDEX_FRACTION
+        return count <= limit or self.row_count - count <= limit
+
+    def get_sorted_index(self, col_num):
+        """ returns a tuple of (order, sorted_values) for a numeric column, building it the first time it is used.
+            order has the row indexes sorted by value (NaN last), and sorted_values the values in that order.
+        """
+
+        if col_num not in self.sorted_indexes:
+            values = self.numeric[col_num][0]
+            order = np.argsort(values).astype(self.get_order_dtype(self.row_count))
+            self.sorted_indexes[col_num] = (order, values[order])
+        return self.sorted_indexes[col_num]
+
+    @staticmethod
+    def get_order_dtype(row_count):
+        return np.min_scalar_type(max(row_count - 1, 0))
+
+    def get_bitmap(self, col_num, code):
+        """ returns the packed bitmap of the rows where a string column holds the distinct value with the given code """
+
+        key = (col_num, code)
+        if key not in self.bitmaps:
+            self.bitmaps[key] = np.packbits(self.strings[col_num][0] == code)
+        return self.bitmaps[key]
+
+    def get_stats_vals(self, col_num):
+        """ returns the numeric values of a column for stats, using 0.0 for missing columns and non-numeric values """
+
+        if col_num is None:
+            return np.zeros(self.row_count)
+
+        values, invalid, invalid_vals = self.numeric[col_num]
+        if invalid_vals:
+            values = np.where(invalid, 0.0, values)
+        return values
+
+
+class ColumnStore(object):
+    """ a directory holding the typed columns of one csv file in a binary columnar format.
+
+        numeric columns are stored as raw float64 values (n<col>.values.bin) with the row indexes and
+        original strings of any non-numeric values (n<col>.invalid_rows.bin, n<col>.invalid_vals.csv).
+        string columns are dictionary encoded as raw integer codes (s<col>.codes.bin) into the distinct
+        values (s<col>.dict.csv). numeric columns may also have a saved sorted index - the row indexes in
+        value order (n<col>.order.bin) and the sorted values (n<col>.sorted.bin). the rows with fewer fields
+        than the header are stored as (row index, number of fields) pairs (ragged_rows.bin).
+        meta.json holds the fingerprint of the csv file the columns were parsed from (path, size, mtime
+        and content hash), the row count, the number of ragged rows and which columns are stored.
+
+        columns are memory mapped when read, so only the pages of the columns an analysis uses are
+        ever read from disk, and those pages are shared by every process analysing the same file.
+
+        several processes (and threads) may write the same store at once. a new store is built in a temporary
+        directory alongside it and renamed into place once complete, and each file is written to a temporary
+        file and renamed over the file, so readers never see a partially written store or file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_meta(self, fn):
+        """ returns the meta data of the store, or None if it does not exist or is out of date with the csv file.
+            a store is up to date while the size and mtime of the csv file match, or if its content hash
+            still matches after the file has been touched or copied.
+        """
+
+        try:
+            with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            st = os.stat(fn)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if meta['size'] != st.st_size or 'ragged_rows' not in meta:
+            # stores written before ragged rows were recorded are rebuilt ...
+            return None
+
+        if meta['mtime'] != st.st_mtime:
+            # the file has been touched - only re-parse it if the content has actually changed ...
+            if meta['hash'] != get_content_hash(fn):
+                return None
+            meta['mtime'] = st.st_mtime
+            try:
+                self._write_meta(meta)
+            except (IOError, OSError):
+                # the store is still up to date - the new mtime is saved the next time it is checked ...
+                pass
+
+        return meta
+
+    def read(self, fn, headers, numeric_cols, string_cols):
+        """ returns a ColumnTable of memory mapped columns, or None if the store is out of date
+            or does not hold all of the given columns
+        """
+
+        meta = self.get_meta(fn)
+        if meta is None:
+            return None
+
+        codes_dtypes = dict(meta['strings'])
+        if not set(numeric_cols) <= set(meta['numeric']) or not set(string_cols) <= set(codes_dtypes):
+            return None
+
+        if self._read_csv_record('headers.csv') != headers:
+            return None
+
+        table = ColumnTable(headers, meta['row_count'])
+        if meta['ragged_rows']:
+            table.ragged_rows = np.fromfile(os.path.join(self.path, 'ragged_rows.bin'), np.int64).reshape(-1, 2)
+
+        for col_num in numeric_cols:
+            values = self._map_column('n{0}.values.bin'.format(col_num), np.float64, table.row_count)
+            invalid_rows = np.fromfile(os.path.join(self.path, 'n{0}.invalid_rows.bin'.format(col_num)), np.int64)
+            invalid_vals = self._read_csv_record('n{0}.invalid_vals.csv'.format(col_num))
+
+            invalid = np.zeros(table.row_count, dtype=bool)
+            invalid[invalid_rows] = True
+            table.numeric[col_num] = (values, invalid, dict(zip(invalid_rows.tolist(), invalid_vals)))
+
+            sorted_index = self._read_sorted_index(col_num, table.row_count)
+            if sorted_index is not None:
+                table.sorted_indexes[col_num] = sorted_index
+
+        for col_num in string_cols:
+            codes = self._map_column('s{0}.codes.bin'.format(col_num), codes_dtypes[col_num], table.row_count)
+            distinct_vals = np.array(self._read_csv_record('s{0}.dict.csv'.format(col_num)), dtype=object)
+            table.strings[col_num] = (codes, distinct_vals)
+
+        return table
+
+    def write(self, fn, table):
+        """ adds the columns of a ColumnTable to the store, replacing the store if it is out of date """
+
+        meta = self.get_meta(fn)
+        if meta is None:
+            with self._build() as store:
+                meta = store._create(fn, table.headers)
+                meta['row_count'] = table.row_count
+                store._write_ragged_rows(meta, table.ragged_rows)
+                store._write_table(meta, table)
+        else:
+            self._write_table(meta, table)
+
+    def _write_ragged_rows(self, meta, ragged_rows):
+        if len(ragged_rows):
+            self._write_column('ragged_rows.bin', np.asarray(ragged_rows, dtype=np.int64))
+        meta['ragged_rows'] = len(ragged_rows)
+
+    def _write_table(self, meta, table):
+        for col_num, (values, invalid, invalid_vals) in table.numeric.items():
+            self._write_numeric(col_num, values, invalid_vals)
+
+        codes_dtypes = dict(meta['strings'])
+        for col_num, (codes, distinct_vals) in table.strings.items():
+            codes = codes.astype(np.min_scalar_type(max(len(distinct_vals) - 1, 0)))
+            self._write_string(col_num, codes, distinct_vals)
+            codes_dtypes[col_num] = codes.dtype.name
+
+        meta['numeric'] = sorted(set(meta['numeric']) | set(table.numeric))
+        meta['strings'] = [[col_num, dtype] for col_num, dtype in sorted(codes_dtypes.items())]
+        self._write_meta(meta)
+
+    def convert(self, fn, block_size=100000):
+        """ converts every column of a csv file into the store, reading blocks of block_size rows at a time.
+
+            a column is stored as numeric if most of its (non-blank) values in the first block are numeric.
+            columns are also dictionary encoded as strings, unless they are numeric and have more than
+            MAX_DICTIONARY_SIZE distinct values - so = filters on low cardinality numeric columns (and all
+            other filters on string columns) are still served from the store.
+        """
+
+        with self._build() as store:
+            store._convert(fn, block_size)
+
+    def _convert(self, fn, block_size):
+        with open_csv(fn) as f:
+            reader = csv.reader(f, delimiter=',', dialect=csv.excel)
+            headers = next(reader, None) or []
+
+            meta = self._create(fn, headers)
+            col_nums = range(len(headers))
+
+            numeric_cols = None
+            string_cols = set(col_nums)
+            dictionaries = dict((col_num, {}) for col_num in col_nums)
+            files = {}
+            ragged_rows = []
+
+            row_count = 0
+            try:
+                while True:
+                    rows = list(itertools.islice(reader, block_size))
+                    if not rows:
+                        break
+
+                    # rows with fewer fields than the header are skipped by the analysis - see ColumnTable.
+                    # they are padded, so every column has a value for every row ...
+                    ragged = [(row_count + x, len(row)) for x, row in enumerate(rows) if len(row) < len(headers)]
+                    if ragged:
+                        ragged_rows.extend(ragged)
+                        rows = [row + [''] * (len(headers) - len(row)) for row in rows]
+                    columns = zip(*rows)
+
+                    if numeric_cols is None:
+                        numeric_cols = set(c for c in col_nums if self._is_numeric_column(columns[c]))
+
+                    for col_num in col_nums:
+                        col = columns[col_num]
+                        if col_num in numeric_cols:
+                            values, invalid, invalid_vals = ColumnTable.parse_numeric(col)
+                            self._append(files, 'n{0}.values.bin'.format(col_num), values)
+                            invalid_rows = sorted(invalid_vals)
+                            self._append(files, 'n{0}.invalid_rows.bin'.format(col_num),
+                                         np.array(invalid_rows, dtype=np.int64) + row_count)
+                            self._append(files, 'n{0}.invalid_vals.csv'.format(col_num),
+                                         [invalid_vals[x] for x in invalid_rows])
+
+                        if col_num in string_cols:
+                            lookup = dictionaries[col_num]
+                            codes = np.fromiter((lookup.setdefault(val, len(lookup)) for val in col),
+                                                dtype=np.uint32, count=len(col))
+                            if col_num in numeric_cols and len(lookup) > MAX_DICTIONARY_SIZE:
+                                # too many distinct values to be worth encoding ...
+                                string_cols.discard(col_num)
+                                dictionaries[col_num] = None
+                                codes_file = files.pop('s{0}.codes.bin'.format(col_num), None)
+                                if codes_file is not None:
+                                    codes_file.close()
+                                    os.remove(codes_file.name)
+                                continue
+                            self._append(files, 's{0}.codes.bin'.format(col_num), codes)
+
+                    row_count += len(rows)
+            finally:
+                for name, f in files.items():
+                    f.close()
+
+        codes_dtypes = []
+        for col_num in sorted(string_cols):
+            lookup = dictionaries[col_num]
+            distinct_vals = sorted(lookup, key=lookup.get)
+            self._write_csv_record('s{0}.dict.csv'.format(col_num), distinct_vals)
+
+            # now the number of distinct values is known, shrink the codes to the smallest integer type ...
+            name = 's{0}.codes.bin'.format(col_num)
+            codes = np.empty(0, dtype=np.uint32)
+            if row_count:
+                codes = np.fromfile(os.path.join(self.path, name), dtype=np.uint32)
+            codes = codes.astype(np.min_scalar_type(max(len(distinct_vals) - 1, 0)))
+            self._write_column(name, codes)
+            codes_dtypes.append([col_num, codes.dtype.name])
+
+        numeric_cols = numeric_cols or set()
+        for col_num in numeric_cols:
+            if not row_count:
+                self._write_numeric(col_num, np.empty(0), {})
+            elif not os.path.exists(os.path.join(self.path, 'n{0}.invalid_vals.csv'.format(col_num))):
+                self._write_csv_record('n{0}.invalid_vals.csv'.format(col_num), [])
+
+        meta['row_count'] = row_count
+        meta['numeric'] = sorted(numeric_cols)
+        meta['strings'] = codes_dtypes
+        self._write_ragged_rows(meta, ragged_rows)
+        self._write_meta(meta)
+
+    def write_sorted_index(self, col_num, order, sorted_values):
+        """ saves the sorted index of a numeric column - see ColumnTable.get_sorted_index """
+
+        self._write_column('n{0}.sorted.bin'.format(col_num), np.asarray(sorted_values, dtype=np.float64))
+        self._write_column('n{0}.order.bin'.format(col_num), np.asarray(order))
+
+    def get_size(self):
+        """ returns the total size of the files in the store, in bytes """
+
+        size = 0
+        for name in os.listdir(self.path):
+            try:
+                size += os.path.getsize(os.path.join(self.path, name))
+            except OSError:
+                # a temporary file which has just been renamed (or removed) ...
+                pass
+        return size
+
+    @contextlib.contextmanager
+    def _build(self):
+        """ yields a new empty ColumnStore in a temporary directory alongside this store, which replaces this
+            store once the block completes. if another process replaces the store first, its store is kept.
+        """
+
+        parent = os.path.dirname(self.path)
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+
+        store = ColumnStore(tempfile.mkdtemp(prefix=os.path.basename(self.path) + '.', suffix=CACHE_TMP_SUFFIX,
+                                             dir=parent))
+        try:
+            yield store
+
+            if os.path.exists(self.path):
+                # move the old store aside, as a directory can not be renamed over one which is not empty ...
+                old_path = tempfile.mkdtemp(prefix=os.path.basename(self.path) + '.', suffix=CACHE_TMP_SUFFIX,
+                                            dir=parent)
+                try:
+                    os.rename(self.path, old_path)
+                except OSError:
+                    pass
+                shutil.rmtree(old_path, ignore_errors=True)
+
+            try:
+                os.rename(store.path, self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        finally:
+            shutil.rmtree(store.path, ignore_errors=True)
+
+    def _create(self, fn, headers):
+        """ starts an empty store for a csv file, and returns its meta data """
+
+        self._write_csv_record('headers.csv', headers)
+
+        st = os.stat(fn)
+        return {'path': os.path.realpath(fn),
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'hash': get_content_hash(fn),
+                'row_count': 0,
+                'ragged_rows': 0,
+                'numeric': [],
+                'strings': []}
+
+    def _is_numeric_column(self, col):
+        numeric = 0
+        non_blank = 0
+        for val in col:
+            if not val:
+                continue
+            non_blank += 1
+            try:
+                float(val)
+                numeric += 1
+            except ValueError:
+                pass
+        return numeric and numeric * 2 >= non_blank
+
+    def _map_column(self, name, dtype, row_count):
+        if not row_count:
+            # empty files can not be memory mapped
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(row_count,))
+
+    def _read_sorted_index(self, col_num, row_count):
+        """ returns the memory mapped (order, sorted_values) index of a numeric column, or None if it is not saved """
+
+        order_name = 'n{0}.order.bin'.format(col_num)
+        if not os.path.exists(os.path.join(self.path, order_name)):
+            return None
+
+        order = self._map_column(order_name, ColumnTable.get_order_dtype(row_count), row_count)
+        sorted_values = self._map_column('n{0}.sorted.bin'.format(col_num), np.float64, row_count)
+        return order, sorted_values
+
+    def _write_numeric(self, col_num, values, invalid_vals):
+        invalid_rows = sorted(invalid_vals)
+        self._write_column('n{0}.values.bin'.format(col_num), values.astype(np.float64))
+        self._write_column('n{0}.invalid_rows.bin'.format(col_num), np.array(invalid_rows, dtype=np.int64))
+        self._write_csv_record('n{0}.invalid_vals.csv'.format(col_num), [invalid_vals[x] for x in invalid_rows])
+
+    def _write_string(self, col_num, codes, distinct_vals):
+        self._write_column('s{0}.codes.bin'.format(col_num), codes)
+        self._write_csv_record('s{0}.dict.csv'.format(col_num), list(distinct_vals))
+
+    def _write_column(self, name, arr):
+        self._write_file(name, arr.tofile)
+
+    def _write_file(self, name, write, mode='wb'):
+        """ writes a file of the store by calling write with a temporary file, which is then renamed over the file """
+
+        fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix=CACHE_TMP_SUFFIX, dir=self.path)
+        try:
+            with os.fdopen(fd, mode) as f:
+                write(f)
+            os.rename(tmp_path, os.path.join(self.path, name))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _append(self, files, name, data):
+        """ appends a block of a column being converted - arrays to .bin files, and lists of strings to .csv files """
+
+        if name.endswith('.csv'):
+            if not data:
+                return
+            if name in files:
+                # each block is written as the continuation of a single record
+                files[name].write(',')
+            else:
+                files[name] = open(os.path.join(self.path, name), 'wb')
+            csv.writer(files[name], lineterminator='').writerow(data)
+        else:
+            if name not in files:
+                files[name] = open(os.path.join(self.path, name), 'wb')
+            data.tofile(files[name])
+
+    def _read_csv_record(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return next(csv.reader(f, delimiter=',', dialect=csv.excel), [])
+
+    def _write_csv_record(self, name, vals):
+        def write(f):
+            if vals:
+                csv.writer(f, lineterminator='').writerow(vals)
+
+        self._write_file(name, write)
+
+    def _write_meta(self, meta):
+        self._write_file('meta.json', functools.partial(json.dump, meta), 'w')
+
+
+class ColumnCache(object):
+    """ an on-disk cache of the ColumnStores of analysed csv files, so they only need to be parsed again when
+        they change. columns are added to a file's store as analyses need them. stores are evicted least
+        recently used first once the cache grows beyond max_size bytes.
+        the cache may be shared by several processes - a store which can not be read or written (e.g. as another
+        process is replacing it) is treated as a cache miss, rather than failing the analysis.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def load(self, fn, headers, numeric_cols, string_cols):
+        """ returns a ColumnTable holding the given columns of a csv file, or None if the
+            cache does not have an up to date store with all of those columns
+        """
+
+        store = self.get_store(fn)
+        try:
+            table = store.read(fn, headers, numeric_cols, string_cols)
+            if table is not None:
+                # the mtime of meta.json records when the store was last used ...
+                os.utime(os.path.join(store.path, 'meta.json'), None)
+        except (IOError, OSError):
+            return None
+        return table
+
+    def store(self, fn, table):
+        """ adds the columns of a ColumnTable to the cached store of a csv file """
+
+        try:
+            self.get_store(fn).write(fn, table)
+        except (IOError, OSError):
+            pass
+
+    @contextlib.contextmanager
+    def lock_file(self, fn):
+        """ does nothing - no lock is needed between processes sharing the cache, as each store (and each file of
+            a store) is built aside and renamed into place, so a reader sees either the old or the new version,
+            and a store which can not be read counts as a miss. two processes which miss together both parse the
+            file, and the last to finish replaces the store of the other. see MemoryCache.lock_file, which does
+            lock, as jobs of the analysis server share the parsed tables.
+        """
+
+        yield
+
+    def is_valid(self, fn):
+        """ returns True if the cache holds an up to date store for a csv file """
+
+        return self.get_store(fn).get_meta(fn) is not None
+
+    def evict(self):
+        """ removes the least recently used stores until the cache is no larger than max_size """
+
+        if not os.path.isdir(self.path):
+            return
+
+        stores = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            store = ColumnStore(os.path.join(self.path, name))
+            if name.endswith(CACHE_TMP_SUFFIX):
+                try:
+                    if time.time() - os.path.getmtime(store.path) < CACHE_TMP_MAX_AGE:
+                        # a store still being built by another process ...
+                        continue
+                except OSError:
+                    continue
+            try:
+                last_used = os.path.getmtime(os.path.join(store.path, 'meta.json'))
+                size = store.get_size()
+            except OSError:
+                # incomplete store - always evict these first
+                last_used = 0
+                size = 0
+            stores.append((last_used, size, store.path))
+            total_size += size
+
+        for last_used, size, path in sorted(stores):
+            if total_size <= self.max_size and last_used:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def get_store(self, fn):
+        return ColumnStore(os.path.join(self.path, hashlib.sha1(os.path.realpath(fn)).hexdigest()))
+
+
+class MemoryCache(object):
+    """ keeps the ColumnTables of analysed csv files in memory, for the analysis server. tables are evicted least
+        recently used first once they hold more than max_size bytes. tables not held in memory are loaded from
+        the optional on-disk ColumnCache, which is also updated with the tables added. safe to share between threads.
+    """
+
+    def __init__(self, max_size, cache=None):
+        self.max_size = max_size
+        self.cache = cache
+
+        self.tables = collections.OrderedDict()  # fn: (version, table, nbytes), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.file_locks = collections.defaultdict(threading.Lock)  # fn: lock - see lock_file
+
+    @contextlib.contextmanager
+    def lock_file(self, fn):
+        """ holds the lock of a csv file while its table is loaded (or parsed) and stored, so jobs analysing the
+            same file at once wait for the first to parse it, rather than parsing and storing it together
+        """
+
+        with self.lock:
+            file_lock = self.file_locks[fn]
+        with file_lock:
+            yield
+
+    def load(self, fn, headers, numeric_cols, string_cols):
+        """ returns a ColumnTable holding the given columns of a csv file, or None if neither memory nor
+            the on-disk cache has an up to date table with all of those columns
+        """
+
+        version = self.get_version(fn)
+        with self.lock:
+            entry = self.tables.get(fn)
+            if entry is not None and entry[0] == version and entry[1].has_columns(numeric_cols, string_cols):
+                self.tables[fn] = self.tables.pop(fn)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        if self.cache is not None:
+            table = self.cache.load(fn, headers, numeric_cols, string_cols)
+            if table is not None:
+                self._add(fn, version, table)
+                return table
+        return None
+
+    def store(self, fn, table):
+        """ adds the columns of a ColumnTable to the table held in memory for a csv file (and the on-disk cache) """
+
+        self._add(fn, self.get_version(fn), table)
+        if self.cache is not None:
+            self.cache.store(fn, table)
+
+    def is_valid(self, fn):
+        with self.lock:
+            entry = self.tables.get(fn)
+        if entry is not None and entry[0] == self.get_version(fn):
+            return True
+        return self.cache is not None and self.cache.is_valid(fn)
+
+    def evict(self):
+        """ evicts the on-disk cache - tables held in memory are evicted as they are added """
+
+        if self.cache is not None:
+            self.cache.evict()
+
+    def get_store(self, fn):
+        return self.cache.get_store(fn) if self.cache is not None else None
+
+    def get_status(self):
+        with self.lock:
+            return {'files': len(self.tables), 'bytes': self.size, 'max_bytes': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def get_version(self, fn):
+        """ returns the (size, mtime) of a csv file - a table is up to date while its file has the same version """
+
+        st = os.stat(fn)
+        return st.st_size, st.st_mtime
+
+    def _add(self, fn, version, table):
+        with self.lock:
+            entry = self.tables.pop(fn, None)
+            if entry is not None:
+                self.size -= entry[2]
+                if entry[0] == version and entry[1].row_count == table.row_count:
+                    # a new table is made, as other threads may be using the current one ...
+                    table = entry[1].combine(table)
+
+            nbytes = table.get_nbytes()
+            self.tables[fn] = (version, table, nbytes)
+            self.size += nbytes
+            self._evict_tables()
+
+    def update_sizes(self):
+        """ counts the size of each table held again, as analyses add bitmaps and sorted indexes to the tables
+            they use, and evicts tables until they fit in max_size bytes again
+        """
+
+        with self.lock:
+            for fn, (version, table, nbytes) in self.tables.items():
+                self.tables[fn] = (version, table, table.get_nbytes())
+            self.size = sum(nbytes for version, table, nbytes in self.tables.values())
+            self._evict_tables()
+
+    def _evict_tables(self):
+        while self.size > self.max_size and len(self.tables) > 1:
+            fn, (version, table, nbytes) = self.tables.popitem(last=False)
+            self.size -= nbytes
+
+
+class QuantileSketch(object):
+    """ a KLL sketch of a stream of values, which estimates its quantiles in constant memory.
+
+        values are held in levels of compactors, where each value in level h stands for 2**h values of the stream.
+        when a level grows beyond its capacity it is sorted, and every other value (alternately starting with the
+        first and the second) is promoted to the level above. capacities shrink by 2/3 for each level below the top,
+        so the sketch never holds more than about 3k values. with k = 2.7 / error, the rank of each estimated
+        quantile is within about error of the true rank. sketches of different parts of a stream can be merged.
+        quantiles are exact until more than k values have been added.
+    """
+
+    def __init__(self, error):
+        self.k = max(8, int(math.ceil(2.7 / error)))
+        self.levels = [np.empty(0)]
+        self.offset = 0
+
+    def update(self, values):
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self._compress()
+
+    def merge(self, other):
+        for h, items in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate((self.levels[h], items))
+        self._compress()
+
+    def get_quantiles(self, qs):
+        """ returns the estimated value of each of the quantiles qs (between 0 and 1) - see np.percentile """
+
+        if len(self.levels) == 1:
+            return np.percentile(self.levels[0], [q * 100 for q in qs])
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.int64) for h, level in enumerate(self.levels)])
+        order = np.argsort(items)
+        items = items[order]
+        ranks = np.cumsum(weights[order])
+
+        # the value at the position of each quantile in the stream, as np.percentile with nearest interpolation ...
+        positions = [round(q * (ranks[-1] - 1)) for q in qs]
+        return items[np.minimum(np.searchsorted(ranks, positions, 'right'), len(items) - 1)]
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            capacity = max(2, int(math.ceil(self.k * (2.0 / 3) ** (len(self.levels) - 1 - h))))
+            if len(self.levels[h]) > capacity:
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+
+                items = np.sort(self.levels[h])
+                # an odd value out stays on this level ...
+                keep = len(items) % 2
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1], items[keep + self.offset::2]))
+                self.levels[h] = items[:keep]
+                self.offset = 1 - self.offset
+            h += 1
+
+
+class StatsAccumulator(object):
+    """ calculates STATS_FORMULAS in one pass, in constant memory: the count, mean and standard deviation exactly
+        with Welford's running algorithm, the min and max exactly, and the quantiles approximately with a
+        QuantileSketch. values are added in batches, and the accumulators of different parts of a file
+        (e.g. the chunks analysed by different workers) can be merged.
+    """
+
+    def __init__(self, quantile_error):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # the sum of the squared differences from the mean
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(quantile_error)
+
+    def update(self, values):
+        if not len(values):
+            return
+
+        values = np.asarray(values, dtype=np.float64)
+        mean = np.mean(values)
+        self._combine(len(values), mean, np.sum((values - mean) ** 2), np.min(values), np.max(values))
+        self.sketch.update(values)
+
+    def merge(self, other):
+        if not other.count:
+            return
+
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        self.sketch.merge(other.sketch)
+
+    def get_stats(self):
+        """ returns the values of STATS_FORMULAS, in order - see App._calculate_stats """
+
+        if not self.count:
+            return [0] + [''] * (len(STATS_FORMULAS) - 1)
+
+        quantiles = self.sketch.get_quantiles((0.25, 0.5, 0.75))
+        return [self.count, self.mean, np.sqrt(self.m2 / self.count), self.min,
+                quantiles[0], quantiles[1], quantiles[2], self.max]
+
+    def _combine(self, count, mean, m2, min_val, max_val):
+        """ combines the count, mean and m2 of another set of values, as per Chan et al's parallel algorithm """
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+        self.min = min_val if self.min is None else min(self.min, min_val)
+        self.max = max_val if self.max is None else max(self.max, max_val)
+
+
+class AnalysisResult(object):
+    """ the outcome of evaluating a set of filters against all, or a chunk of, a csv file """
+
+    def __init__(self, num_filters, collect_stats, quantile_error=None):
+        self.row_count = 0
+        self.quantile_error = quantile_error
+
+        # counts, stats, missing fields and errors all have an entry for each filter.
+        # a filter using a field missing from the file is not evaluated at all, and so matches no rows.
+        # errors are grouped by (field, col_num, message), with the number of rows in each group and
+        # a sample of up to MAX_ERROR_SAMPLES (row index, value) tuples, in row order ...
+        self.counts = [0] * num_filters
+
+        # the matched values of each of STATS_FIELDS for each filter, or a StatsAccumulator of them
+        # if a quantile error is given for approximate stats ...
+        self.stats = None
+        if collect_stats and quantile_error is not None:
+            self.stats = [dict((field, StatsAccumulator(quantile_error)) for field in STATS_FIELDS)
+                          for i in range(num_filters)]
+        elif collect_stats:
+            self.stats = [dict((field, np.empty(0)) for field in STATS_FIELDS) for i in range(num_filters)]
+        self.missing_fields = [[] for i in range(num_filters)]
+        self.errors = [{} for i in range(num_filters)]
+
+        # recorded for profiling - where the rows were read from ('csv', 'columnar' or 'cache'),
+        # how many bytes were read and the time spent, in seconds, parsing them and evaluating the filters.
+        # filter_times has the evaluation time of each filter when they are evaluated one at a time ...
+        self.source = None
+        self.bytes_read = 0
+        self.parse_time = 0.0
+        self.evaluate_time = 0.0
+        self.filter_times = None
+
+    def merge(self, other):
+        """ merges in the result of the chunk of the file directly following the chunk(s) in this result """
+
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+
+        if self.stats is not None:
+            for filter_stats, other_stats in zip(self.stats, other.stats):
+                for field in STATS_FIELDS:
+                    if self.quantile_error is not None:
+                        filter_stats[field].merge(other_stats[field])
+                    else:
+                        filter_stats[field] = np.concatenate((filter_stats[field], other_stats[field]))
+
+        for i, other_errors in enumerate(other.errors):
+            for key, (count, samples) in other_errors.items():
+                self.add_errors(i, key, count, [(x + self.row_count, val) for x, val in samples])
+
+        self.row_count += other.row_count
+
+        self.bytes_read += other.bytes_read
+        self.parse_time += other.parse_time
+        self.evaluate_time += other.evaluate_time
+        if self.filter_times is not None and other.filter_times is not None:
+            self.filter_times = [t + other_t for t, other_t in zip(self.filter_times, other.filter_times)]
+
+    def add_errors(self, i, key, count, samples):
+        """ adds count errors to the (field, col_num, message) group of filter i, sampling the first of the
+            (row index, value) samples given. samples must follow those already added in row order.
+        """
+
+        group = self.errors[i].get(key)
+        if group is None:
+            group = self.errors[i][key] = [0, []]
+        group[0] += count
+        if len(group[1]) < MAX_ERROR_SAMPLES:
+            group[1].extend(samples[:MAX_ERROR_SAMPLES - len(group[1])])
+
+    def get_errors(self, i):
+        """ returns the errors of filter i as a (missing_fields, groups) tuple, where each group is a
+            [field, col_num, message, count, samples] list, in column order
+        """
+
+        groups = [[field, col_num, message, count, samples]
+                  for (field, col_num, message), (count, samples) in sorted(self.errors[i].items())]
+        return self.missing_fields[i], groups
+
+    def get_error_count(self, i):
+        return sum(count for count, samples in self.errors[i].values())
+
+
+class CsvAnalyser(object):
+    """ evaluates a set of filters against csv files.
+        instances are picklable, so files (or chunks of files) can be analysed in worker processes.
+    """
+
+    def __init__(self, csv_path, filters, collect_stats, engine=ENGINE_COLUMNAR, cache=None, columnar_path=None,
+                 profile=False, case_sensitive=True, quantile_error=None):
+        self.csv_path = csv_path
+        self.filters = filters
+        self.collect_stats = collect_stats
+        self.engine = engine
+        self.cache = cache
+        self.columnar_path = columnar_path
+        self.case_sensitive = case_sensitive
+
+        # when set, the streaming engine times the csv reader separately from the filters.
+        # (the columnar engine always records its timings, as they cost nothing measurable) ...
+        self.profile = profile
+
+        # when set, stats are calculated approximately, in constant memory - see StatsAccumulator ...
+        self.quantile_error = quantile_error
+
+    def analyse(self, csv_file, start=None, end=None, lines=None):
+        """ evaluates every filter against every row of a csv file in a single pass
+            Args:
+                csv_file: the CsvFile to analyse
+                start: optional byte offset of the first record to analyse, as returned by split()
+                end: optional byte offset at which to stop analysing, as returned by split()
+                lines: optional lines of the whole csv file, as returned by Prefetcher.get(), if it is being read ahead
+            Returns:
+                an AnalysisResult
+        """
+
+        result = AnalysisResult(len(self.filters), self.collect_stats, self.quantile_error)
+
+        fn = os.path.join(self.csv_path, csv_file.filename)
+        f = open_csv(fn) if lines is None else contextlib.closing(lines)
+        with f as f:
+            # rows are streamed straight from the reader, so only the per-filter state is held in memory ...
+            # the engines project the reader onto the columns they need ...
+            reader = ProjectingReader(f)
+
+            headers = next(reader, None)
+            if headers is None:
+                # empty file - nothing to analyse
+                return result
+
+            result.source = 'csv'
+            if start is None:
+                result.bytes_read = os.path.getsize(fn)
+            else:
+                result.bytes_read = end - start
+                reader = ProjectingReader(self._read_chunk(fn, start, end))
+
+            if self.engine == ENGINE_COLUMNAR:
+                # only whole files are converted or cached ...
+                self._evaluate_columns(headers, reader, result, fn if start is None else None)
+            else:
+                self._evaluate_rows(headers, reader, result)
+
+        return result
+
+    def split(self, csv_file, chunk_size):
+        """ splits a csv file into chunks of roughly chunk_size bytes, which can be analysed independently.
+            chunks always start at the beginning of a record, so quoted fields spanning several lines are never split.
+            Returns:
+                a list of (start, end) byte offsets, or [(None, None)] if the file is not worth splitting
+        """
+
+        fn = os.path.join(self.csv_path, csv_file.filename)
+        size = os.path.getsize(fn)
+        if size <= chunk_size or fn.endswith(GZIP_SUFFIX):
+            # gzipped files can not be read from an offset ...
+            return [(None, None)]
+
+        if not self.needs_csv(csv_file):
+            # loading a converted or cached file is quicker than parsing chunks in parallel ...
+            return [(None, None)]
+
+        with open(fn, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # the first boundary is the end of the header ...
+                targets = range(0, size, chunk_size)
+                offsets = sorted(set(self._find_record_starts(m, targets)))
+            finally:
+                m.close()
+
+        offsets = [o for o in offsets if o < size]
+        if not offsets:
+            return [(None, None)]
+        return zip(offsets, offsets[1:] + [size])
+
+    def needs_csv(self, csv_file):
+        """ returns False if the columnar engine can load a csv file from its converted store or the cache,
+            rather than parsing it
+        """
+
+        if self.engine == ENGINE_COLUMNAR:
+            fn = os.path.join(self.csv_path, csv_file.filename)
+            if self.columnar_path is not None and self._get_columnar_store(fn).get_meta(fn) is not None:
+                return False
+            if self.cache is not None and self.cache.is_valid(fn):
+                return False
+        return True
+
+    def _find_record_starts(self, m, targets):
+        """ returns the offset of the first record starting after each of the (ascending) target offsets.
+            follows the csv.excel quoting rules: a quote only opens a quoted field at the start of a field,
+            and a doubled quote within a quoted field is an escaped quote.
+        """
+
+        starts = []
+        state = (0, -1)
+        counted = 0
+        nl = -1
+
+        for target in targets:
+            nl = m.find('\n', max(target, nl + 1))
+            while nl != -1:
+                state = self._count_quotes(m, counted, nl, state)
+                counted = nl
+                if state[0] % 2 == 0:
+                    # not within a quoted field ...
+                    break
+                nl = m.find('\n', nl + 1)
+
+            if nl == -1:
+                break
+            starts.append(nl + 1)
+        return starts
+
+    def _count_quotes(self, m, start, end, state):
+        """ counts the quotes which open or close a quoted field between two offsets of a memory mapped file.
+            an escaped quote counts as closing the field and opening it again, so a newline is within a quoted
+            field if an odd number of quotes come before it.
+            Args:
+                state: a tuple of the number of quotes counted before start, and the offset of the last of them
+            Returns:
+                the state at end
+        """
+
+        count, last = state
+        for block_start in xrange(start, end, QUOTE_SCAN_BLOCK_SIZE):
+            block_end = min(block_start + QUOTE_SCAN_BLOCK_SIZE, end)
+            # include the byte before the block, to check the quotes at its start ...
+            offset = max(block_start - 1, 0)
+            data = np.frombuffer(m, dtype=np.uint8, count=block_end - offset, offset=offset)
+            quotes = np.flatnonzero(data == QUOTE_BYTE) + offset
+            quotes = quotes[quotes >= block_start]
+            if not len(quotes):
+                continue
+
+            # in a well formed block every other quote opens a field, so follows a delimiter, a newline or the
+            # quote before it (the first quote of the file has nothing before it) ...
+            opening = quotes[count % 2::2]
+            opening = opening[opening > 0]
+            prev = data[opening - offset - 1]
+            if (np.in1d(prev, FIELD_START_BYTES) | ((prev == QUOTE_BYTE) &
+                                                    ((opening > block_start) | (opening - 1 == last)))).all():
+                count += len(quotes)
+                last = int(quotes[-1])
+                continue
+
+            # otherwise some quotes are within unquoted fields, and are not counted ...
+            for q in quotes.tolist():
+                if count % 2 or q == 0 or m[q - 1] in ',\r\n' or q - 1 == last:
+                    count += 1
+                    last = q
+        return count, last
+
+    def _read_chunk(self, fn, start, end):
+        """ returns a line iterator over a chunk of a file, with the same newline handling as 'rU' mode """
+
+        return cStringIO.StringIO(read_csv_data(fn, start, end))
+
+    def _evaluate_rows(self, headers, reader, result):
+        """ streams the rows from the reader through a FilterEvaluator, holding only the per-filter state """
+
+        compiled_filters = self._compile_filters(headers)
+        for i, f in enumerate(compiled_filters):
+            result.missing_fields[i] = f.missing_fields
+
+        # filters using missing fields match no rows, so are not evaluated ...
+        filter_indexes = [i for i, f in enumerate(compiled_filters) if not f.missing_fields]
+        compiled_filters = [compiled_filters[i] for i in filter_indexes]
+        stats_cols = self._get_col_nums(headers, STATS_FIELDS)
+
+        # each numeric column used by a condition (or the stats) is parsed once per row,
+        # and each string column compared case insensitively is lower cased once per row ...
+        conditions = [c for f in compiled_filters for c in f.conditions]
+        numeric_cols = set(c.col_num for c in conditions if c.compare is not None)
+        if result.stats is not None:
+            numeric_cols.update(col_num for col_num in stats_cols if col_num is not None)
+        fold_cols = set(c.col_num for c in conditions if c.compare is None and not c.case_sensitive)
+        decoder = RowDecoder(numeric_cols, fold_cols)
+        evaluator = FilterEvaluator(compiled_filters, decoder)
+        reader.project(numeric_cols.union(c.col_num for c in conditions), len(headers))
+
+        # the index of each of the stats values in the decoded values - missing fields are always 0.0 ...
+        stats_indexes = [decoder.indexes.get(col_num) for col_num in stats_cols]
+
+        counts = result.counts
+        stats = None
+        if result.stats is not None:
+            stats = [dict((field, array.array('d')) for field in STATS_FIELDS) for f in self.filters]
+
+        ragged_rows = reader.ragged_rows
+        timer = None
+        if self.profile:
+            timer = [0.0]
+            reader = self._time_reader(reader, timer)
+        started = time.time()
+
+        # approximate stats are added to their accumulators in batches, so memory use stays constant ...
+        batch_size = STATS_BATCH_SIZE if result.quantile_error is not None else None
+
+        x = -1
+        for x, row in enumerate(reader):
+            if row is None:
+                # the row has fewer fields than the header ...
+                continue
+            if batch_size is not None and stats is not None and x % batch_size == 0:
+                self._add_stats(result, stats)
+
+            values, failures = decoder.decode(row)
+            stats_vals = None
+            for i, match in itertools.izip(filter_indexes, evaluator.evaluate(row, values, failures)):
+                if match is True:
+                    counts[i] += 1
+                    if stats is not None:
+                        if stats_vals is None:
+                            stats_vals = [self._get_stats_val(values, failures, j) for j in stats_indexes]
+                        for field, val in zip(STATS_FIELDS, stats_vals):
+                            stats[i][field].append(val)
+                elif match is not False:
+                    key = (headers[match.col_num], match.col_num, match.message)
+                    result.add_errors(i, key, 1, [(x, row[match.col_num])])
+
+        result.row_count = x + 1
+        self._add_ragged_rows(result, filter_indexes, ragged_rows)
+
+        if timer is not None:
+            result.parse_time = timer[0]
+            result.evaluate_time = time.time() - started - timer[0]
+
+        if stats is not None:
+            self._add_stats(result, stats)
+
+    def _add_ragged_rows(self, result, filter_indexes, ragged_rows):
+        """ logs the rows with fewer fields than the header, which are skipped, as errors of each filter evaluated.
+            ragged_rows has a (row index, number of fields) pair for each row, in row order.
+        """
+
+        if not len(ragged_rows):
+            return
+        samples = [(int(x), int(fields)) for x, fields in ragged_rows[:MAX_ERROR_SAMPLES]]
+        for i in filter_indexes:
+            result.add_errors(i, RAGGED_ROW_KEY, len(ragged_rows), samples)
+
+    def _add_stats(self, result, stats):
+        """ adds the values matched by each filter to the stats of the result - to the accumulators of
+            approximate stats, emptying the buffers, and otherwise as the arrays of stats values
+        """
+
+        for filter_stats, vals in zip(result.stats, stats):
+            for field in STATS_FIELDS:
+                field_vals = np.frombuffer(vals[field]) if vals[field] else np.empty(0)
+                if result.quantile_error is not None:
+                    filter_stats[field].update(field_vals)
+                    vals[field] = array.array('d')
+                else:
+                    filter_stats[field] = field_vals
+
+    def _time_reader(self, reader, timer):
+        """ yields the rows of a reader, adding the time spent reading them to timer[0] """
+
+        reader = iter(reader)
+        while True:
+            started = time.time()
+            row = next(reader, None)
+            timer[0] += time.time() - started
+            if row is None:
+                return
+            yield row
+
+    def _evaluate_columns(self, headers, reader, result, fn=None):
+        """ loads the columns needed by the filters and STATS_FIELDS into a ColumnTable, and evaluates
+            each filter as a boolean mask over all the rows at once. if fn is given, the columns are loaded
+            from the converted columnar store of the file or the cache when possible - see _load_table.
+
+            the outcome, including which rows are reported as errors, is identical to _evaluate_rows:
+            a condition is only applied to rows which passed the conditions before it in the filter,
+            and a row with invalid data is logged as an error and excluded from the rest of the filter.
+        """
+
+        compiled_filters = self._compile_filters(headers)
+        stats_cols = self._get_col_nums(headers, STATS_FIELDS)
+
+        numeric_cols = set(col_num for col_num in stats_cols if col_num is not None and result.stats is not None)
+        string_cols = set()
+        for f in compiled_filters:
+            for c in f.conditions:
+                if c.col_num is not None:
+                    (string_cols if c.compare is None else numeric_cols).add(c.col_num)
+
+        started = time.time()
+        reader.project(numeric_cols | string_cols, len(headers))
+        table, source, store = self._load_table(fn, headers, reader, numeric_cols, string_cols)
+        result.parse_time = time.time() - started
+
+        # sorted indexes are only built for tables kept in a store, where they are saved for later analyses ...
+        saved_indexes = set(table.sorted_indexes)
+        result.row_count = table.row_count
+        if source != 'csv':
+            result.source = source
+            result.bytes_read = table.get_nbytes()
+        result.filter_times = [0.0] * len(compiled_filters)
+
+        stats_vals = None
+        if result.stats is not None:
+            stats_vals = [table.get_stats_vals(col_num) for col_num in stats_cols]
+
+        # masks are packed bitmaps, so a filter is the AND of the bitmaps of its conditions.
+        # conditions shared by several filters are only evaluated once ...
+        cond_masks = {}
+        all_rows = np.ones(table.row_count, dtype=bool)
+        all_rows[table.ragged_rows[:, 0]] = False
+        all_rows = np.packbits(all_rows)
+        self._add_ragged_rows(result, [i for i, f in enumerate(compiled_filters) if not f.missing_fields],
+                              table.ragged_rows)
+
+        for i, f in enumerate(compiled_filters):
+            if f.missing_fields:
+                # the filter matches no rows ...
+                result.missing_fields[i] = f.missing_fields
+                continue
+
+            started = time.time()
+            match = all_rows.copy()
+
+            for c in f.conditions:
+                if c.key not in cond_masks:
+                    cond_masks[c.key] = self._get_condition_mask(table, c, store is not None)
+                passed, invalid, any_passed = cond_masks[c.key]
+
+                if invalid is not None:
+                    rows = np.flatnonzero(np.unpackbits(match & invalid))
+                    if len(rows):
+                        invalid_vals = table.numeric[c.col_num][2]
+                        samples = [(int(x), invalid_vals[x]) for x in rows[:MAX_ERROR_SAMPLES]]
+                        result.add_errors(i, (c.field, c.col_num, INVALID_DATA_MESSAGE), len(rows), samples)
+
+                match &= passed
+                if not any_passed:
+                    # no rows can match, so the rest of the conditions can not find any more errors ...
+                    break
+
+            result.counts[i] = int(POPCOUNT[match].sum(dtype=np.int64))
+
+            if stats_vals is not None:
+                match = np.unpackbits(match)[:table.row_count].view(bool)
+                for field, vals in zip(STATS_FIELDS, stats_vals):
+                    if result.quantile_error is not None:
+                        result.stats[i][field].update(vals[match])
+                    else:
+                        result.stats[i][field] = vals[match]
+
+            result.filter_times[i] = time.time() - started
+
+        result.evaluate_time = sum(result.filter_times)
+
+        for col_num in set(table.sorted_indexes) - saved_indexes:
+            try:
+                store.write_sorted_index(col_num, *table.sorted_indexes[col_num])
+            except (IOError, OSError):
+                # the index is built again by the next analysis ...
+                pass
+
+    def _load_table(self, fn, headers, reader, numeric_cols, string_cols):
+        """ loads the given columns from the converted columnar store of a csv file if it has an up to date one,
+            otherwise from the cache, and otherwise parses them from the reader (adding them to the cache)
+            Returns:
+                a tuple of (ColumnTable, source, store), where source is 'columnar', 'cache' or 'csv',
+                and store is the ColumnStore holding the table, or None if it is not stored
+        """
+
+        if fn is not None:
+            if self.columnar_path is not None:
+                store = self._get_columnar_store(fn)
+                table = store.read(fn, headers, numeric_cols, string_cols)
+                if table is not None:
+                    return table, 'columnar', store
+
+            if self.cache is not None:
+                # the ColumnCache lock does nothing, as processes sharing it can only waste work parsing a file
+                # together, and never see a store which is part written. the MemoryCache of the analysis server
+                # locks the file, so its jobs wait for the first of them to parse it ...
+                with self.cache.lock_file(fn):
+                    table = self.cache.load(fn, headers, numeric_cols, string_cols)
+                    if table is not None:
+                        return table, 'cache', self.cache.get_store(fn)
+
+                    table = ColumnTable.load(headers, reader, numeric_cols, string_cols)
+                    self.cache.store(fn, table)
+                    return table, 'csv', self.cache.get_store(fn)
+
+        table = ColumnTable.load(headers, reader, numeric_cols, string_cols)
+        return table, 'csv', None
+
+    def convert(self, csv_file):
+        """ converts a csv file into its columnar store """
+
+        fn = os.path.join(self.csv_path, csv_file.filename)
+        self._get_columnar_store(fn).convert(fn)
+
+    def _get_columnar_store(self, fn):
+        return ColumnStore(os.path.join(self.columnar_path, os.path.basename(fn)))
+
+    def _get_condition_mask(self, table, c, build_index=False):
+        """ returns a tuple of (passed, invalid, any_passed) for a condition, where passed and invalid are
+            packed bitmaps, and invalid is None if the column has no invalid data. rows with invalid data never pass.
+            range conditions use the sorted index of the column when it has one, and the range is narrow enough.
+            otherwise every row is compared, and if build_index is set and the range turns out to be narrow,
+            the sorted index of the column is built for the next analysis.
+        """
+
+        invalid = None
+
+        if c.compare is None:
+            passed = table.isin(c.col_num, c.vals, c.case_sensitive)
+        else:
+            values, invalid, invalid_vals = table.numeric[c.col_num]
+            passed = table.get_range(c.col_num, c.op, c.threshold)
+            if passed is None:
+                with np.errstate(invalid='ignore'):
+                    passed = c.compare(values, c.threshold)
+                if build_index and table.is_narrow_range(np.count_nonzero(passed)):
+                    table.get_sorted_index(c.col_num)
+                passed = np.packbits(passed)
+
+            invalid = np.packbits(invalid) if invalid_vals else None
+
+        return passed, invalid, bool(passed.any())
+
+    def _compile_filters(self, headers):
+        """ compiles the filters against the headers of a csv file """
+
+        return [CompiledFilter(f, headers, self.case_sensitive) for f in self.filters]
+
+    def _get_col_nums(self, headers, fields):
+        """ returns the column index of each field, or None if the field does not exist """
+
+        return [headers.index(field) if field in headers else None for field in fields]
+
+    def _get_stats_val(self, values, failures, j):
+        """ returns the decoded value at index j for stats, or 0.0 if the field does not exist or is not numeric """
+
+        if j is None or failures >> j & 1:
+            return 0.0
+        return values[j]
+
+
+def _analyse_csv_file(args):
+    """ entry point for worker processes - multiprocessing can only call module level functions """
+
+    analyser, csv_file, start, end = args
+    return analyser.analyse(csv_file, start, end)
+
+
+class Prefetcher(object):
+    """ reads csv files in a background thread ahead of their analysis, so waiting on storage overlaps with
+        evaluating the filters. files are read in order, in blocks of PREFETCH_BLOCK_SIZE bytes, up to depth files
+        ahead of the file being analysed. reading waits while the blocks read but not yet analysed hold max_bytes
+        of memory, so only a bounded part of any file is held, however large it is.
+    """
+
+    def __init__(self, filenames, depth, max_bytes):
+        """ Args:
+                filenames: the csv files to read, in the order they will be analysed, or None for those not needed
+                depth: the number of files to read ahead
+                max_bytes: the memory budget of the blocks read ahead
+        """
+
+        self.filenames = filenames
+        self.depth = depth
+        self.max_bytes = max_bytes
+
+        self.blocks = collections.defaultdict(collections.deque)  # index: blocks read and not yet taken
+        self.finished = {}  # index: None once a file has been read, or the exception raised reading it
+        self.discarded = set()  # indexes of the files whose remaining blocks are no longer needed
+        self.position = -1  # the number of files taken before the one being analysed
+        self.held_bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, i):
+        """ returns the lines of file i, as they are read, with the same newline handling as open_csv.
+            the lines must be closed once analysed - see PrefetchedLines.
+        """
+
+        if self.filenames[i] is None:
+            return None
+
+        with self.condition:
+            self.position = len([fn for fn in self.filenames[:i] if fn is not None])
+            self.condition.notify_all()
+        return PrefetchedLines(self, i)
+
+    def close(self):
+        """ stops reading ahead, and releases the blocks not yet taken - waiting for any read in progress """
+
+        with self.condition:
+            self.closed = True
+            self.blocks.clear()
+            self.condition.notify_all()
+
+        self.thread.join()
+
+    def get_blocks(self, i):
+        """ yields the blocks of file i as they are read
+            Raises:
+                IOError or OSError: if the file could not be read
+        """
+
+        while True:
+            with self.condition:
+                while not self.blocks[i] and i not in self.finished and not self.closed:
+                    # a timeout keeps the wait interruptible ...
+                    self.condition.wait(1)
+
+                if self.blocks[i]:
+                    block = self.blocks[i].popleft()
+                    self.held_bytes -= len(block)
+                    self.condition.notify_all()
+                elif self.finished.get(i) is not None:
+                    raise self.finished[i]
+                else:
+                    return
+            yield block
+
+    def discard(self, i):
+        """ releases the blocks of file i not yet taken, and stops reading it """
+
+        with self.condition:
+            self.discarded.add(i)
+            self.held_bytes -= sum(len(block) for block in self.blocks.pop(i, ()))
+            self.condition.notify_all()
+
+    def _run(self):
+        position = 0
+        for i, fn in enumerate(self.filenames):
+            if fn is None:
+                continue
+
+            with self.condition:
+                while position > self.position + self.depth and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+            position += 1
+
+            error = None
+            try:
+                with contextlib.closing(gzip.open(fn, 'rb') if fn.endswith(GZIP_SUFFIX) else open(fn, 'rb')) as f:
+                    while self._wait_for_room(i):
+                        block = f.read(PREFETCH_BLOCK_SIZE)
+                        if not block:
+                            break
+                        if block.endswith('\r'):
+                            # keep a \r\n newline in one block ...
+                            block += f.read(1)
+
+                        block = block.replace('\r\n', '\n').replace('\r', '\n')
+                        with self.condition:
+                            if i not in self.discarded and not self.closed:
+                                self.blocks[i].append(block)
+                                self.held_bytes += len(block)
+                                self.condition.notify_all()
+            except (IOError, OSError) as e:
+                error = e
+
+            with self.condition:
+                self.finished[i] = error
+                self.condition.notify_all()
+
+    def _wait_for_room(self, i):
+        """ waits until there is room in the memory budget for another block of file i.
+            returns False if file i is no longer needed.
+        """
+
+        with self.condition:
+            while self.held_bytes >= self.max_bytes and self.held_bytes and not self.closed and i not in self.discarded:
+                self.condition.wait()
+            return not self.closed and i not in self.discarded
+
+
+class PrefetchedLines(object):
+    """ iterates over the lines of a csv file read ahead by a Prefetcher - see Prefetcher.get """
+
+    def __init__(self, prefetcher, i):
+        self.prefetcher = prefetcher
+        self.i = i
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(cStringIO.StringIO(text) for text in self._get_texts())
+
+    def close(self):
+        self.prefetcher.discard(self.i)
+
+    def _get_texts(self):
+        """ yields the blocks of the file, split after their last newline so every line is whole """
+
+        tail = ''
+        for block in self.prefetcher.get_blocks(self.i):
+            text = tail + block
+            end = text.rfind('\n') + 1
+            tail = text[end:]
+            if end:
+                yield text[:end]
+        if tail:
+            yield tail
+
+
+def _convert_csv_file(args):
+    """ entry point for worker processes converting csv files """
+
+    analyser, csv_file = args
+    analyser.convert(csv_file)
+    return csv_file
+
+
+class IncrementalState(object):
+    """ the results of the previous analysis for each file and filter, so that a re-run only needs to analyse
+        the cells of the results whose csv file or filter has changed.
+
+        cells are keyed by the analysis type, the content hash of the csv file and a hash of the filter
+        (and the case sensitivity setting), so renaming a file or reordering the filters does not invalidate them.
+        content hashes are only recalculated for files whose size or mtime has changed. cells which were not used
+        by the latest analysis are dropped when the state is saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # realpath: {size, mtime, hash}
+        self.cells = {}  # key: {cells, errors}
+        self.used_files = set()
+        self.used_keys = set()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            if state.get('version') == INCREMENTAL_STATE_VERSION:
+                self.files = state['files']
+                self.cells = state['cells']
+        except (IOError, OSError, ValueError, KeyError):
+            # no previous state, or it is unreadable - everything will be analysed
+            pass
+
+    def save(self):
+        state = {'version': INCREMENTAL_STATE_VERSION,
+                 'files': dict((path, self.files[path]) for path in self.used_files),
+                 'cells': dict((key, self.cells[key]) for key in self.used_keys if key in self.cells)}
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.path)
+
+    def get_file_hash(self, fn):
+        path = os.path.realpath(fn)
+        st = os.stat(fn)
+
+        entry = self.files.get(path)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            entry = {'size': st.st_size, 'mtime': st.st_mtime, 'hash': get_content_hash(fn)}
+            self.files[path] = entry
+        self.used_files.add(path)
+        return entry['hash']
+
+    def get_key(self, analysis_type, file_hash, conditions, case_sensitive):
+        filter_hash = hashlib.sha1(json.dumps([conditions, case_sensitive], sort_keys=True)).hexdigest()
+        key = '{0}:{1}:{2}'.format(analysis_type, file_hash, filter_hash)
+        self.used_keys.add(key)
+        return key
+
+    def get(self, key):
+        """ returns a tuple of (cells, errors) for a key, or None if it was not in the previous analysis.
+            errors are in the form returned by AnalysisResult.get_errors
+        """
 
-DEFAULT_IN_DIR = 'unfiltered_CLC_data'
-DEFAULT_OUT_FILE = 'results.csv'
-DEFAULT_ERROR_FILE = 'errors.csv'
-DEFAULT_FILTER_FILE = 'filters.csv'
-DEFAULT_SAMPLE_FILTER_FILE = 'filters_SAMPLE.csv'
+        cell = self.cells.get(key)
+        if cell is None:
+            return None
+        return cell['cells'], cell['errors']
 
-SUPPORTED_OPERATORS = ('=', '<', '<=', '>', '>=')
+    def put(self, key, cells, errors):
+        self.cells[key] = {'cells': cells, 'errors': errors}
 
-RE_FILE = '^.*_([0-9]{3})_g1_.*\.csv$'
-RE_FILTER = '([=><]+)(.*)'
 
-CSV_PATTERN = '_123_g1_'
+class CsvSink(object):
+    """ writes csv rows to a file as they are produced, so the rows never need to be held in memory.
 
-ACTION_PRINT_CSVS = 1
-ACTION_PRINT_FILTERS = 2
-ACTION_RESCAN_CSVS = 3
-ACTION_RESCAN_FILTERS = 4
-ACTION_GENERATE_SAMPLE_FILTERS = 5
-ACTION_DO_COUNT_ANALYSIS = 6
-ACTION_DO_STATS_ANALYSIS = 7
-ACTION_SETTINGS = 8
-ACTION_EXIT = 9
+        rows are written to a temporary file alongside the file, which replaces the file when the sink is closed.
+        a run which fails part way through leaves any existing file untouched rather than half written.
+        the header is written before the first row. a sink closed without any rows still replaces the file with
+        just the header, unless remove_if_empty is set, in which case any existing file is removed instead.
+        use as a context manager - the file is replaced on success, and the temporary file removed on an exception.
+    """
 
-ACTION_SETTING_EDIT_CASE_SENSITIVITY = 1
-ACTION_SETTING_EDIT_CSV_PATH = 2
-ACTION_SETTING_EDIT_FILTER_PATH = 3
-ACTION_SETTING_EDIT_OUT_PATH = 4
-ACTION_SETTING_RESTORE_DEFAULTS = 5
+    def __init__(self, path, header=None, remove_if_empty=False):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.header = header
+        self.remove_if_empty = remove_if_empty
+        self.row_count = 0
 
-ANALYSIS_TYPE_COUNT = 'count'
-ANALYSIS_TYPE_STATS = 'stats'
+        self.f = None
+        self.writer = None
 
-STATS_FORMULAS = ('Count', 'Mean', 'Standard deviation', 'Min', '25% Quantile', '50% Quantile', '75% Quantile', 'Max')
-STATS_FIELDS = ('Frequency', 'Read count', 'Coverage')
+    def __enter__(self):
+        return self
 
-SAMPLE_FILTERS = (
-    'Count,>= 10,>=100',
-    'Coverage,>=10,>=100',
-    'Forward read count,>=5,>=50',
-    'Reverse read count,>=5,>=50',
-    'dbSNP,BLANK,BLANK',
-    'Type,"Deletion,Insertion,MNV,Replacement","Deletion,MNV"',
-    'Frequency,>=2.5,IGNORE',
-    'Non-synonymous,"Yes,No,-","Yes,-"',
-    'COSMIC,BLANK,IGNORE')
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
+    def writerow(self, row):
+        if self.f is None:
+            self._open()
 
-class AnalysisException(Exception):
-    def __init__(self, message, col_num=None):
-        self.message = message
-        self.col_num = col_num
+        self.writer.writerow(row)
+        self.row_count += 1
 
+    def close(self):
+        if self.f is None:
+            if self.remove_if_empty:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            self._open()
 
-class DuplicateCsvNumException(Exception):
-    def __init__(self, num, fn1, fn2):
-        self.num = num
-        self.fn1 = fn1
-        self.fn2 = fn2
+        self.f.close()
+        self.f = None
+        os.rename(self.tmp_path, self.path)
 
+    def abort(self):
+        if self.f is None:
+            return
 
-class InvalidFilterOperatorException(Exception):
-    def __init__(self, cell, condition):
-        self.cell = cell
-        self.condition = condition
+        self.f.close()
+        self.f = None
+        os.remove(self.tmp_path)
 
+    def _open(self):
+        self.f = open(self.tmp_path, 'wb')
+        self.writer = csv.writer(self.f)
+        if self.header is not None:
+            self.writer.writerow(self.header)
 
-class InvalidFilterValueException(Exception):
-    def __init__(self, cell, condition):
-        self.cell = cell
-        self.condition = condition
 
+class Profiler(object):
+    """ records where the time of a run goes, to tell whether parsing, filtering or stats is to blame
+        when an analysis is slow.
 
-class CsvFile(object):
-    def __init__(self, num, filename):
-        self.num = num
-        self.filename = filename
+        each phase of the run records its wall time, cpu time and the peak memory at its end. phases which
+        run many times (e.g. _calculate_stats) are totalled instead. each csv file analysed records where
+        its rows were read from, the rows and bytes read, the time spent parsing them and evaluating the
+        filters, and the rows matched by each filter. parse and evaluation times are measured in whichever
+        process analysed the file, and summed over its chunks.
 
-        self.num_str = '{0:03d}'.format(num)
+        if a dump path is given, the main process is also profiled with cProfile, and the stats are saved in
+        the pstats format read by snakeviz, gprof2dot and flameprof.
+        a disabled profiler records nothing.
+    """
+
+    def __init__(self, enabled=True, dump_path=None):
+        self.enabled = enabled
+        self.dump_path = dump_path
+
+        self.started = time.time()
+        self.phases = []
+        self.totals = {}  # name: {calls, wall_time, cpu_time}
+        self.files = []
+
+        self.profile = None
+        if enabled and dump_path is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name, accumulate=False):
+        """ times the body of a with statement as a phase of the run, or adds it to the total of the phase """
+
+        if not self.enabled:
+            yield
+            return
+
+        started = time.time()
+        started_cpu = time.clock()
+        try:
+            yield
+        finally:
+            wall_time = time.time() - started
+            cpu_time = time.clock() - started_cpu
+            if accumulate:
+                total = self.totals.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0})
+                total['calls'] += 1
+                total['wall_time'] += wall_time
+                total['cpu_time'] += cpu_time
+            else:
+                self.phases.append({'name': name,
+                                    'wall_time': wall_time,
+                                    'cpu_time': cpu_time,
+                                    'peak_rss_kb': self.get_peak_rss()})
+
+    def add_file(self, csv_file, filter_indexes, result, num_filters):
+        """ records the AnalysisResult of a csv file, analysed against the filters with the given indexes.
+            the other filters had their results reused from the previous analysis.
+        """
+
+        if not self.enabled:
+            return
+
+        filters = [{'filter': i + 1, 'reused': True} for i in range(num_filters)]
+        entry = {'num': csv_file.num, 'file': csv_file.filename, 'filters': filters}
+
+        if result is not None:
+            entry.update({'source': result.source,
+                          'rows_read': result.row_count,
+                          'bytes_read': result.bytes_read,
+                          'parse_time': result.parse_time,
+                          'evaluate_time': result.evaluate_time})
+
+            for j, i in enumerate(filter_indexes):
+                filters[i] = {'filter': i + 1,
+                              'reused': False,
+                              'rows_matched': result.counts[j],
+                              'missing_fields': result.missing_fields[j],
+                              'errors': result.get_error_count(j),
+                              'evaluate_time': result.filter_times[j] if result.filter_times is not None else None}
+
+        self.files.append(entry)
+
+    def get_report(self):
+        analysed = [f for f in self.files if 'rows_read' in f]
+        return {'started': datetime.datetime.fromtimestamp(self.started).strftime('%Y-%m-%dT%H:%M:%S'),
+                'wall_time': time.time() - self.started,
+                'peak_rss_kb': self.get_peak_rss(),
+                'phases': self.phases,
+                'totals': self.totals,
+                'files': self.files,
+                'rows_read': sum(f['rows_read'] for f in analysed),
+                'bytes_read': sum(f['bytes_read'] for f in analysed),
+                'parse_time': sum(f['parse_time'] for f in analysed),
+                'evaluate_time': sum(f['evaluate_time'] for f in analysed)}
+
+    def save(self, fn=None):
+        """ stops profiling, saving the cProfile stats to the dump path and the json report to fn (if given) """
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.dump_path)
+
+        if fn is not None:
+            with open(fn, 'w') as f:
+                json.dump(self.get_report(), f, indent=2, sort_keys=True)
+
+    def get_peak_rss(self):
+        """ returns the peak resident set size of this process and its finished worker processes in KB,
+            or None if it is not available on this platform
+        """
+
+        if resource is None:
+            return None
+
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform == 'darwin':
+            # reported in bytes on OS X
+            own /= 1024
+            children /= 1024
+        return max(own, children)
+
+
+def profiled(accumulate=False):
+    """ decorates an App method, so each call is timed by the app's Profiler - see Profiler.phase """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.phase(fn.__name__, accumulate):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class App(object):
     def __init__(self):
         self.case_sensitive = True
+        self.workers = DEFAULT_WORKERS
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.engine = DEFAULT_ENGINE
+        self.use_cache = True
+        self.cache_size = DEFAULT_CACHE_SIZE
+        self.prefetch = DEFAULT_PREFETCH
+        self.prefetch_memory = DEFAULT_PREFETCH_MEMORY
+        self.incremental = False
+        self.quantile_error = None  # stats are exact unless a quantile error is set
+        self.table_cache = None  # a MemoryCache used instead of the on-disk cache, by the analysis server
+        self.recursive = False  # whether csv files are also found in sub folders of the CSV Input Directory
 
         self.root_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -114,14 +2480,16 @@ class App(object):
         self.sample_filter_file_path = os.path.join(self.root_path, DEFAULT_SAMPLE_FILTER_FILE)
 
         self.settings_path = os.path.join(os.path.expanduser("~"), '.csv-filter-analysis')
+        self.cache_path = os.path.join(os.path.expanduser("~"), DEFAULT_CACHE_DIR)
 
         self.load_settings()
 
         self.csv_filenames = []
         self.filters = []
 
-        self.results = []
-        self.error_log = []
+        self.error_count = 0
+
+        self.profiler = Profiler(enabled=False)
 
         self.first_run = True
 
@@ -161,6 +2529,8 @@ class App(object):
                    ' 6) Perform Count Analysis\n'
                    ' 7) Perform Stats Analysis\n'
                    ' 8) View / Edit Settings\n'
+                   ' 9) Convert CSV Files to Columnar Format\n'
+                   '10) Perform Count & Stats Analysis\n'
                    # ' H) Help\n'
                    ' Q) Exit\n\n')
             msg = msg.format(len(self.csv_filenames),
@@ -193,6 +2563,10 @@ class App(object):
                 self.do_analysis(ANALYSIS_TYPE_STATS)
             elif action == ACTION_SETTINGS:
                 self.view_settings()
+            elif action == ACTION_CONVERT_CSVS:
+                self.convert_csvs()
+            elif action == ACTION_DO_COMBINED_ANALYSIS:
+                self.do_analysis(ANALYSIS_TYPE_COMBINED)
             else:
                 msg = '\nSorry, I do not understand "{0}". Hit any key to continue ...'.format(action)
                 raw_input(msg)
@@ -237,10 +2611,11 @@ class App(object):
             msg = msg.format(e2.num, e2.fn1, e2.fn2, CSV_PATTERN)
             raw_input(msg)
 
+    @profiled()
     def _scan_for_csvs(self):
         num_fn = {}
-        for filename in os.listdir(self.csv_path):
-            r = re.match(RE_FILE, filename)
+        for filename in self._list_csv_path():
+            r = RE_FILE.match(os.path.basename(filename))
             if not r:
                 continue
             num = r.group(1)
@@ -250,9 +2625,138 @@ class App(object):
 
             num_fn[num] = filename
 
-        csv_filenames = [CsvFile(int(k), v) for k, v in num_fn.items()]
+        csv_filenames = [CsvFile(int(k), v) for k, v in sorted(num_fn.items())]
         self.csv_filenames = csv_filenames
 
+    def _list_csv_path(self):
+        """ returns the names of the files in the CSV Input Directory - and in recursive mode, the paths
+            (relative to it) of the files in its sub folders, other than the converted columnar stores
+        """
+
+        if not self.recursive:
+            return os.listdir(self.csv_path)
+
+        def onerror(e):
+            if e.filename == self.csv_path:
+                raise e
+
+        filenames = []
+        for path, dirs, files in os.walk(self.csv_path, onerror=onerror):
+            rel_path = os.path.relpath(path, self.csv_path)
+            if rel_path == os.curdir:
+                rel_path = ''
+                dirs[:] = [d for d in dirs if d != DEFAULT_COLUMNAR_DIR]
+            filenames.extend(os.path.join(rel_path, fn) for fn in files)
+        return filenames
+
+    def _watch(self, analysis_type, interval=DEFAULT_WATCH_INTERVAL, settle_time=DEFAULT_WATCH_SETTLE_TIME,
+               log=None, log_error=None):
+        """ watches the CSV Input Directory (and Filters Input File) after an analysis, updating the results
+            whenever csv files are added, changed or removed, until interrupted.
+
+            the directory is polled every interval seconds, and a new or changed csv file is only analysed once
+            it has gone unchanged for settle_time seconds, so files still being written are left out of the results
+            until they are complete. the analysis is incremental, so only the new and changed files are analysed.
+            log is called with a message describing each update, and log_error with any error.
+        """
+
+        log = log or (lambda msg: None)
+        log_error = log_error or log
+        self.incremental = True
+
+        last_error = [None]
+
+        def error(msg):
+            # an error is only logged once, however many checks find it ...
+            if msg != last_error[0]:
+                log_error(msg)
+            last_error[0] = msg
+
+        def get_versions():
+            versions = {}
+            for csv_file in self.csv_filenames:
+                try:
+                    st = os.stat(os.path.join(self.csv_path, csv_file.filename))
+                except OSError:
+                    # removed since the scan ...
+                    continue
+                versions[csv_file.filename] = (st.st_size, st.st_mtime)
+            return versions
+
+        def get_filters_version():
+            try:
+                return os.path.getmtime(self.filter_file_path)
+            except OSError:
+                return None
+
+        analysed = get_versions()
+        filters_version = get_filters_version()
+        pending = {}  # filename: (version, time first seen)
+
+        while True:
+            time.sleep(interval)
+
+            try:
+                self._scan_for_csvs()
+            except DuplicateCsvNumException, e:
+                error('duplicate number "{0}" found in "{1}" and "{2}"'.format(e.num, e.fn1, e.fn2))
+                continue
+            except OSError:
+                error('CSV folder not found: {0}'.format(self.csv_path))
+                continue
+
+            now = time.time()
+            versions = get_versions()
+            changed = [fn for fn, version in versions.items() if analysed.get(fn) != version]
+            removed = [fn for fn in analysed if fn not in versions]
+
+            for fn in changed:
+                if pending.get(fn, (None,))[0] != versions[fn]:
+                    pending[fn] = (versions[fn], now)
+            for fn in pending.keys():
+                if fn not in versions:
+                    del pending[fn]
+            ready = [fn for fn in changed if now - pending[fn][1] >= settle_time]
+
+            filters_changed = get_filters_version() != filters_version
+            if filters_changed:
+                filters_version = get_filters_version()
+                try:
+                    self._scan_for_filters()
+                except (IOError, InvalidFilterOperatorException, InvalidFilterValueException):
+                    error('the filters could not be loaded from {0}'.format(self.filter_file_path))
+                    continue
+
+            if not ready and not removed and not filters_changed:
+                continue
+
+            # files which are still being written are left out until they are complete ...
+            waiting = set(changed) - set(ready)
+            self.csv_filenames = [f for f in self.csv_filenames if f.filename in versions and f.filename not in waiting]
+
+            try:
+                self._do_analysis(analysis_type)
+            except (IOError, OSError), e:
+                error(str(e))
+                continue
+
+            analysed = dict((f.filename, versions[f.filename]) for f in self.csv_filenames)
+            last_error[0] = None
+            for fn in ready:
+                del pending[fn]
+
+            msg = '{0}: analysed {1} new or changed file{2}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), len(ready), '' if len(ready) == 1 else 's')
+            if removed:
+                msg += ', removed {0}'.format(len(removed))
+            if filters_changed:
+                msg += ', with the updated filters'
+            if waiting:
+                msg += ' - waiting for {0} file{1} to be complete'.format(len(waiting), '' if len(waiting) == 1 else 's')
+            log(msg + ' ({0} errors)'.format(self.error_count))
+            for fn in sorted(ready):
+                log(' ' + fn)
+
     def scan_for_filters(self):
         try:
             self._scan_for_filters()
@@ -284,6 +2788,7 @@ class App(object):
             msg = msg.format(e1.cell, e1.condition)
             raw_input(msg)
 
+    @profiled()
     def _scan_for_filters(self):
         """ parses the filters.csv file and returns a data structure similar to the following:
 
@@ -293,58 +2798,61 @@ class App(object):
             }]
         """
 
-        filters = []
         with open(self.filter_file_path, 'rU') as f:
-            reader = csv.reader(f, delimiter=',', dialect=csv.excel)
-
-            for x, row in enumerate(reader):
-                field = None
-                for y, col in enumerate(row):
-                    cell = '%s%s' % (self._get_cell_ref(y+1), x+1)
-                    if y == 0:
-                        field = col
-                        continue
-
-                    if len(filters) < y:
-                        filters.append([])
-
-                    f = filters[y-1]
-
-                    condition = col
-
-                    r = re.match(RE_FILTER, condition)
-
-                    if r and len(r.groups()) == 2:
-                        op = r.group(1)
-                        val = r.group(2)
-                        if op not in SUPPORTED_OPERATORS:
-                            raise InvalidFilterOperatorException(cell, condition)
-
-                        # comparison has to be numeric
-                        try:
-                            val = float(val)
-                        except:
-                            raise InvalidFilterValueException(cell, condition)
+            self.filters = self._parse_filters(csv.reader(f, delimiter=',', dialect=csv.excel))
 
-                        f.append({'field': field,
-                                  'op': op,
-                                  'vals': [val]})
-                    elif condition == 'BLANK':
-                        # means match empty string ...
-                        f.append({'field': field,
-                                  'op': '=',
-                                  'vals': ['']})
+    def _parse_filters(self, reader):
+        """ parses the rows of a filters csv file - see _scan_for_filters """
 
-                    elif condition == 'IGNORE':
-                        pass
-                    else:
-                        # the only other option is a comma separated list of strings, which serve as an OR condition
-                        vals = map(lambda c: c.strip(), condition.split(','))
-                        f.append({'field': field,
-                                  'op': '=',
-                                  'vals': vals})
-
-        self.filters = filters
+        filters = []
+        for x, row in enumerate(reader):
+            field = None
+            for y, col in enumerate(row):
+                cell = '%s%s' % (self._get_cell_ref(y+1), x+1)
+                if y == 0:
+                    field = col
+                    continue
+
+                if len(filters) < y:
+                    filters.append([])
+
+                f = filters[y-1]
+
+                condition = col
+
+                r = re.match(RE_FILTER, condition)
+
+                if r and len(r.groups()) == 2:
+                    op = r.group(1)
+                    val = r.group(2)
+                    if op not in SUPPORTED_OPERATORS:
+                        raise InvalidFilterOperatorException(cell, condition)
+
+                    # comparison has to be numeric
+                    try:
+                        val = float(val)
+                    except:
+                        raise InvalidFilterValueException(cell, condition)
+
+                    f.append({'field': field,
+                              'op': op,
+                              'vals': [val]})
+                elif condition == 'BLANK':
+                    # means match empty string ...
+                    f.append({'field': field,
+                              'op': '=',
+                              'vals': ['']})
+
+                elif condition == 'IGNORE':
+                    pass
+                else:
+                    # the only other option is a comma separated list of strings, which serve as an OR condition
+                    vals = map(lambda c: c.strip(), condition.split(','))
+                    f.append({'field': field,
+                              'op': '=',
+                              'vals': vals})
+
+        return filters
 
     def generate_sample_filters(self):
         if os.path.exists(self.sample_filter_file_path):
@@ -409,8 +2917,49 @@ class App(object):
                                              val if val else "''")
         raw_input('\nHit any key to continue ...')
 
+    def convert_csvs(self):
+        if not self.csv_filenames:
+            raw_input('\nNo CSV files have been found.\nPlease use option (3) to re-scan.\nHit any key to continue ...')
+            return
+
+        columnar_path = os.path.join(self.csv_path, DEFAULT_COLUMNAR_DIR)
+        msg = ('\nThis will convert {0} CSV files to a columnar format, which is much quicker to analyse.\n'
+               'Converted files will be saved to {1}\n'
+               'and are used automatically until the CSV file they were converted from changes.\n\n'
+               'Do you wish to continue? (YES|NO)\n')
+
+        action = raw_input(msg.format(len(self.csv_filenames), columnar_path))
+        if action.upper() == 'YES':
+            print '\nConverting, please wait ...'
+            for csv_file in self._convert_csvs():
+                print ' {0}\t{1}'.format(csv_file.num_str, csv_file.filename)
+            raw_input('\nConversion complete.\nHit any key to continue ...')
+        else:
+            raw_input('\nConversion cancelled. No changes have been made.\nHit any key to continue ...')
+
+    def _convert_csvs(self):
+        """ converts each csv file into the columnar format read by the columnar engine
+            Yields:
+                each CsvFile once it has been converted
+        """
+
+        analyser = CsvAnalyser(self.csv_path, self.filters, False, ENGINE_COLUMNAR, None,
+                               os.path.join(self.csv_path, DEFAULT_COLUMNAR_DIR))
+        tasks = [(analyser, csv_file) for csv_file in self.csv_filenames]
+
+        if self.workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+            try:
+                for csv_file in pool.imap(_convert_csv_file, tasks):
+                    yield csv_file
+            finally:
+                pool.terminate()
+        else:
+            for task in tasks:
+                yield _convert_csv_file(task)
+
     def do_analysis(self, analysis_type):
-        assert analysis_type in (ANALYSIS_TYPE_COUNT, ANALYSIS_TYPE_STATS)
+        assert analysis_type in (ANALYSIS_TYPE_COUNT, ANALYSIS_TYPE_STATS, ANALYSIS_TYPE_COMBINED)
 
         if not self.filters or not self.csv_filenames:
             msg = ('It is not possible to start the analysis without at least 1 input CSV file and 1 filter.'
@@ -423,204 +2972,342 @@ class App(object):
                'WARNING: ANY EXISTING RESULTS WILL BE OVERWRITTEN!!!\n\n'
                'Do you wish to continue? (YES|NO)\n')
 
-        msg = msg.format(len(self.filters), len(self.csv_filenames), self.out_file_path)
+        out_paths = ' and '.join(self._get_out_file_paths(analysis_type))
+        msg = msg.format(len(self.filters), len(self.csv_filenames), out_paths)
         action = raw_input(msg)
         if action.upper() == 'YES':
             print '\nAnalysing, please wait ...'
             time.sleep(1)
 
-            if analysis_type == ANALYSIS_TYPE_COUNT:
-                self._do_count_analysis()
-            elif analysis_type == ANALYSIS_TYPE_STATS:
-                self._do_stats_analysis()
-
-            self.write_results()
-            self.write_errors()
+            self._do_analysis(analysis_type)
 
             msg = ('\nAnalysis complete with {0} errors\n'
-                   'Results have been saved to {1}\n').format(len(self.error_log), self.out_file_path)
-            if self.error_log:
+                   'Results have been saved to {1}\n').format(self.error_count, out_paths)
+            if self.error_count:
                 msg += 'Errors have been logged in {0}'.format(self.error_log_file_path)
             msg += 'Do you wish to open the results now? (YES|NO)\n'
 
-            msg = msg.format(len(self.error_log), self.out_file_path)
+            msg = msg.format(self.error_count, out_paths)
 
             a = raw_input(msg)
             if a.upper() == 'YES':
-                os.system('open ' + self.out_file_path)
+                for path in self._get_out_file_paths(analysis_type):
+                    os.system('open ' + path)
         else:
             raw_input('\nAnalysis cancelled. No changes have been made.\nHit any key to continue ...')
 
+    @profiled()
     def _do_count_analysis(self):
-        header = ['Num', 'File']
-        for i, f in enumerate(self.filters):
-            header.append('Filter {0}'.format(i + 1))
-        self.results = [header]
+        self._write_results(ANALYSIS_TYPE_COUNT, self._get_results_header(ANALYSIS_TYPE_COUNT))
 
-        for csv_file in self.csv_filenames:
-            result = [csv_file.num_str, csv_file.filename]
+    @profiled()
+    def _do_stats_analysis(self):
+        self._write_results(ANALYSIS_TYPE_STATS, self._get_results_header(ANALYSIS_TYPE_STATS))
+
+    @profiled()
+    def _do_combined_analysis(self):
+        self._write_results(ANALYSIS_TYPE_COMBINED, self._get_results_header(ANALYSIS_TYPE_COUNT),
+                            self._get_results_header(ANALYSIS_TYPE_STATS))
+
+    def _do_analysis(self, analysis_type):
+        if analysis_type == ANALYSIS_TYPE_COUNT:
+            self._do_count_analysis()
+        elif analysis_type == ANALYSIS_TYPE_STATS:
+            self._do_stats_analysis()
+        elif analysis_type == ANALYSIS_TYPE_COMBINED:
+            self._do_combined_analysis()
+
+    def _get_out_file_paths(self, analysis_type):
+        """ returns the files the results of an analysis are written to. a combined analysis writes its counts
+            to the Results Output File, and its stats to a file alongside it - see STATS_OUT_FILE_SUFFIX.
+        """
 
-            fn = os.path.join(self.csv_path, csv_file.filename)
-            with open(fn, 'rU') as f:
-                reader = csv.reader(f, delimiter=',', dialect=csv.excel)
-
-                headers = None
-                rows = []
-                for x, row in enumerate(reader):
-                    if x == 0:
-                        headers = row
-                    else:
-                        rows.append(row)
-
-                for f in self.filters:
-                    count = 0
-                    for x, row in enumerate(rows):
-                        try:
-                            if self._check_filter(headers, row, f, csv_file.filename):
-                                count += 1
-                        except AnalysisException, e:
-                            cell = ''
-                            if e.col_num is not None:
-                                cell = '%s%s' % (self._get_cell_ref(e.col_num+1), x+2)
-                            self.error_log.append((csv_file.filename, cell, e.message))
-                    result.append(count)
-            self.results.append(result)
+        if analysis_type != ANALYSIS_TYPE_COMBINED:
+            return [self.out_file_path]
 
-    def _do_stats_analysis(self):
+        root, ext = os.path.splitext(self.out_file_path)
+        return [self.out_file_path, root + STATS_OUT_FILE_SUFFIX + ext]
+
+    def _get_results_header(self, analysis_type):
         header = ['Num', 'File']
         for i, f in enumerate(self.filters):
+            if analysis_type == ANALYSIS_TYPE_COUNT:
+                header.append('Filter {0}'.format(i + 1))
+                continue
+
             for field in STATS_FIELDS:
                 for formula in STATS_FORMULAS:
                     header.append('Filter {0} {1} {2}'.format(i + 1, field, formula))
-        self.results = [header]
+        return header
 
-        for csv_file in self.csv_filenames:
-            result = [csv_file.num_str, csv_file.filename]
+    def _write_results(self, analysis_type, header, stats_header=None):
+        """ writes the results of each csv file to the Results Output File as soon as it has been analysed,
+            and its errors to the error log - see CsvSink. the error log is only written if errors are found,
+            and a previous error log is removed if not.
+            a combined analysis also writes its stats, with the stats header, to the stats output file.
+        """
 
-            fn = os.path.join(self.csv_path, csv_file.filename)
-            with open(fn, 'rU') as f:
-                reader = csv.reader(f, delimiter=',', dialect=csv.excel)
-
-                headers = None
-                rows = []
-                for x, row in enumerate(reader):
-                    if x == 0:
-                        headers = row
-                    else:
-                        rows.append(row)
-
-                for f in self.filters:
-                    stats = {'Frequency': [],
-                             'Read count': [],
-                             'Coverage': []}
-
-                    for x, row in enumerate(rows):
-                        try:
-                            if self._check_filter(headers, row, f, csv_file.filename):
-                                for field in STATS_FIELDS:
-                                    val = self._get_numeric_val(headers, row, field)
-                                    stats[field].append(val)
-
-                        except AnalysisException, e:
-                            cell = ''
-                            if e.col_num is not None:
-                                cell = '%s%s' % (self._get_cell_ref(e.col_num+1), x+2)
-                            self.error_log.append((csv_file.filename, cell, e.message))
-
-                    for field in STATS_FIELDS:
-                        for formula in STATS_FORMULAS:
-                            stat_val = self._calculate_stat(formula, stats[field])
-                            result.append(stat_val)
-            self.results.append(result)
-
-    def _calculate_stat(self, formula, data):
-        val = 0.0
-        if formula == 'Count':
-            val = len(data)
-        elif formula == 'Mean':
-            val = np.mean(data)
-        elif formula == 'Standard deviation':
-            val = np.std(data)
-        elif formula == 'Min':
-            val = min(data)
-        elif formula == '25% Quantile':
-            val = np.percentile(data, 25)
-        elif formula == '50% Quantile':
-            val = np.percentile(data, 50)
-        elif formula == '75% Quantile':
-            val = np.percentile(data, 75)
-        elif formula == 'Max':
-            val = max(data)
-        return val
-
-    def _get_numeric_val(self, headers, row, field):
-        if field not in headers:
-            # field does not exist - return 0.0
-            return 0.0
+        self.error_count = 0
 
-        col_num = headers.index(field)
-        val = row[col_num]
+        out_paths = self._get_out_file_paths(analysis_type)
+        stats_results = None
+        if analysis_type == ANALYSIS_TYPE_COMBINED:
+            stats_results = CsvSink(out_paths[1], stats_header)
 
+        errors = CsvSink(self.error_log_file_path, ERROR_LOG_HEADER, remove_if_empty=True)
         try:
-            val = float(val)
-            return val
+            with CsvSink(out_paths[0], header) as results, errors:
+                for csv_file, cells in self._get_filter_results(analysis_type, errors):
+                    rows = self._get_result_rows(analysis_type, csv_file, cells)
+                    results.writerow(rows[0])
+                    if stats_results is not None:
+                        stats_results.writerow(rows[1])
         except:
-            # val is not numeric - return 0.0
-            return 0.0
+            if stats_results is not None:
+                stats_results.abort()
+            raise
+
+        if stats_results is not None:
+            stats_results.close()
+
+    def _get_result_rows(self, analysis_type, csv_file, cells):
+        """ returns the rows of the results of a csv file, from the cells of each filter - see _get_filter_results.
+            a combined analysis has a row of counts followed by a row of stats, other analyses have a single row.
+        """
 
-    def _check_filter(self, headers, row, filters, filename):
-        for f in filters:
-            field = f['field']
-            op = f['op']
-            vals = f['vals']
+        if analysis_type != ANALYSIS_TYPE_COMBINED:
+            cell_slices = [slice(None)]
+        else:
+            # the first cell of each filter is its count, followed by its stats - see _get_result_cells ...
+            cell_slices = [slice(None, 1), slice(1, None)]
+
+        rows = []
+        for cell_slice in cell_slices:
+            row = [csv_file.num_str, csv_file.filename]
+            for filter_cells in cells:
+                row.extend(filter_cells[cell_slice])
+            rows.append(row)
+        return rows
+
+    def _get_filter_results(self, analysis_type, errors_sink):
+        """ analyses each csv file, in num order, writing any errors found to the errors sink - see _write_errors.
+            in incremental mode, cells from the previous analysis are reused for the csv files and filters
+            which have not changed, and only the remaining cells are analysed.
+            Yields:
+                a tuple of (csv_file, cells) for each csv file, where cells has a list of result cells for each filter
+        """
 
-            if field not in headers:
-                raise AnalysisException('Field "{0}" not found'.format(field))
+        state = None
+        if self.incremental:
+            state = IncrementalState(self._get_incremental_state_path())
+            state.load()
 
-            col_num = headers.index(field)
-            val = row[col_num]
+        # approximate stats are saved apart from exact stats, and from those of other rank errors ...
+        state_type = analysis_type
+        if analysis_type != ANALYSIS_TYPE_COUNT and self.quantile_error is not None:
+            state_type = '{0}~{1!r}'.format(analysis_type, self.quantile_error)
 
-            try:
-                if op == '=' and val not in vals:
-                    return False
-                elif op == '<' and not float(val) < float(vals[0]):
-                    return False
-                elif op == '<=' and not float(val) <= float(vals[0]):
-                    return False
-                elif op == '>=' and not float(val) >= float(vals[0]):
-                    return False
-            except ValueError:
-                msg = 'Invalid data - greater/less than queries can only be performed on numeric data ({0} {1} {2})'
-                msg = msg.format(val, op, val)
-                raise AnalysisException(msg, col_num)
+        jobs = []
+        reused = {}
+        keys = {}
+        for csv_file in self.csv_filenames:
+            filter_results = [None] * len(self.filters)
 
-        return True
+            if state is not None:
+                file_hash = state.get_file_hash(os.path.join(self.csv_path, csv_file.filename))
+                keys[csv_file] = [state.get_key(state_type, file_hash, f, self.case_sensitive) for f in self.filters]
+                filter_results = [state.get(key) for key in keys[csv_file]]
+
+            reused[csv_file] = filter_results
+            jobs.append((csv_file, [i for i, r in enumerate(filter_results) if r is None]))
 
-    def write_results(self):
-        self._write_csv_data_to_file(self.out_file_path, self.results)
+        collect_stats = analysis_type != ANALYSIS_TYPE_COUNT
+        for csv_file, filter_indexes, analysis in self._analyse_csv_files(collect_stats, jobs):
+            filter_results = reused.pop(csv_file)
+            self.profiler.add_file(csv_file, filter_indexes, analysis, len(self.filters))
 
-    def write_errors(self):
-        if self.error_log:
-            self._write_csv_data_to_file(self.error_log_file_path, self.error_log)
+            for j, i in enumerate(filter_indexes):
+                filter_results[i] = (self._get_result_cells(analysis_type, analysis, j), analysis.get_errors(j))
+                if state is not None:
+                    state.put(keys[csv_file][i], *filter_results[i])
 
-    def _write_csv_data_to_file(self, filename, csv_data):
-        """ writes csv data to a file
+            self._write_errors(errors_sink, csv_file, [errors for cells, errors in filter_results])
+
+            yield csv_file, [cells for cells, errors in filter_results]
+
+        if state is not None:
+            state.save()
+
+    def _write_errors(self, errors_sink, csv_file, filter_errors):
+        """ writes the errors found in a csv file by each filter to the errors sink, combined across the filters.
+            a missing field is logged once, with the number of filters skipped because of it.
+            row errors are logged once per column and error, with the number of errors and a sample of the cells.
+            rows with fewer fields than the header are logged once, with a sample of the rows.
+            Args:
+                errors_sink: the CsvSink of the error log
+                csv_file: the CsvFile the errors were found in
+                filter_errors: the errors of each filter, in the form returned by AnalysisResult.get_errors
+        """
+
+        missing_fields = []
+        skipped_filters = {}
+        groups = {}  # (col_num, message): [field, count, {row index: value}]
+
+        for filter_missing_fields, filter_groups in filter_errors:
+            for field in filter_missing_fields:
+                if field not in skipped_filters:
+                    missing_fields.append(field)
+                    skipped_filters[field] = 0
+                skipped_filters[field] += 1
+
+            for field, col_num, message, count, samples in filter_groups:
+                group = groups.setdefault((col_num, message), [field, 0, {}])
+                if col_num is None:
+                    # every filter skips the same ragged rows, so they are only counted once ...
+                    group[1] = max(group[1], count)
+                else:
+                    group[1] += count
+                group[2].update(samples)
+
+        for field in missing_fields:
+            errors_sink.writerow((csv_file.filename, field, MISSING_FIELD_MESSAGE.format(field),
+                                  skipped_filters[field], ''))
+            self.error_count += 1
+
+        for (col_num, message), (field, count, samples) in sorted(groups.items()):
+            if col_num is None:
+                # the samples of ragged rows have the number of fields in the row ...
+                cells = ['Row %s (%s fields)' % (x+2, val) for x, val in sorted(samples.items())[:MAX_ERROR_SAMPLES]]
+            else:
+                cells = ['%s%s (%s)' % (self._get_cell_ref(col_num+1), x+2, val)
+                         for x, val in sorted(samples.items())[:MAX_ERROR_SAMPLES]]
+            errors_sink.writerow((csv_file.filename, field, message, count, ', '.join(cells)))
+            self.error_count += count
+
+    def _get_result_cells(self, analysis_type, analysis, i):
+        """ returns the cells of the results for filter i of an AnalysisResult.
+            the cells of a combined analysis are the count, followed by the stats.
+        """
+
+        if analysis_type == ANALYSIS_TYPE_COUNT:
+            return [analysis.counts[i]]
+
+        stats = [analysis.stats[i][field] for field in STATS_FIELDS]
+        if analysis.quantile_error is not None:
+            stats = [accumulator.get_stats() for accumulator in stats]
+        else:
+            stats = self._calculate_stats(stats)
+
+        cells = []
+        if analysis_type == ANALYSIS_TYPE_COMBINED:
+            cells.append(analysis.counts[i])
+        for field_stat_vals in stats:
+            cells.extend(field_stat_vals)
+        return cells
+
+    def _get_incremental_state_path(self):
+        return self.out_file_path + INCREMENTAL_STATE_SUFFIX
+
+    def _analyse_csv_files(self, collect_stats, jobs):
+        """ analyses csv files against some (or all) of the filters.
+            when more than one worker is configured, files are spread across a pool of worker processes,
+            and files larger than the chunk size are split into chunks which are analysed in parallel.
             Args:
-                filename: the filename of the file to write to
-                csv_data: a 2d list of data
+                collect_stats: whether to collect the values of STATS_FIELDS for matching rows
+                jobs: a list of (csv_file, filter_indexes) tuples, with the indexes of the filters to analyse each file against
+            Yields:
+                a tuple of (csv_file, filter_indexes, AnalysisResult) for each job, in order.
+                the AnalysisResult is None if there were no filters to analyse the file against.
         """
 
-        s = StringIO.StringIO()
-        w = csv.writer(s)
+        cache = self.table_cache
+        if cache is None and self.use_cache:
+            cache = ColumnCache(self.cache_path, self.cache_size)
+
+        analysers = {}
+        tasks = []
+        for csv_file, filter_indexes in jobs:
+            if not filter_indexes:
+                continue
+
+            key = tuple(filter_indexes)
+            if key not in analysers:
+                analysers[key] = CsvAnalyser(self.csv_path, [self.filters[i] for i in filter_indexes], collect_stats,
+                                             self.engine, cache, os.path.join(self.csv_path, DEFAULT_COLUMNAR_DIR),
+                                             self.profiler.enabled, self.case_sensitive, self.quantile_error)
+            analyser = analysers[key]
+
+            if self.workers > 1:
+                tasks.extend((analyser, csv_file, start, end) for start, end in analyser.split(csv_file, self.chunk_size))
+            else:
+                tasks.append((analyser, csv_file, None, None))
+
+        pool = None
+        prefetcher = None
+        if self.workers > 1 and len(tasks) > 1:
+            # each worker process reads its own files, so reading already overlaps with analysis ...
+            pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+            outcomes = pool.imap(_analyse_csv_file, tasks)
+        elif self.prefetch > 0:
+            # the csv files which will be parsed are read ahead in blocks while the current one is analysed
+            # (chunks of files are read by the analyser) ...
+            filenames = [os.path.join(self.csv_path, task[1].filename)
+                         if task[2] is None and task[0].needs_csv(task[1]) else None for task in tasks]
+            prefetcher = Prefetcher(filenames, self.prefetch, self.prefetch_memory)
+            outcomes = (analyser.analyse(csv_file, start, end, prefetcher.get(x))
+                        for x, (analyser, csv_file, start, end) in enumerate(tasks))
+        else:
+            outcomes = itertools.imap(_analyse_csv_file, tasks)
+
+        try:
+            # tasks (and so outcomes) are in job order, with the chunks of each file in order ...
+            chunks_by_file = itertools.groupby(itertools.izip(tasks, outcomes), lambda t: t[0][1])
+
+            for csv_file, filter_indexes in jobs:
+                if not filter_indexes:
+                    yield csv_file, filter_indexes, None
+                    continue
+
+                task_csv_file, chunks = next(chunks_by_file)
+                result = None
+                for task, outcome in chunks:
+                    if result is None:
+                        result = outcome
+                    else:
+                        result.merge(outcome)
+
+                yield csv_file, filter_indexes, result
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if prefetcher is not None:
+                prefetcher.close()
+            if cache is not None:
+                cache.evict()
+
+    @profiled(accumulate=True)
+    def _calculate_stats(self, data):
+        """ calculates every formula in STATS_FORMULAS for several equal length arrays of values at once
+            Args:
+                data: a list of numpy arrays, e.g. the matched values for each of STATS_FIELDS
+            Returns:
+                a list with the values of STATS_FORMULAS, in order, for each array
+        """
 
-        for results in csv_data:
-            w.writerow(results)
+        count = len(data[0])
+        if not count:
+            # no matching rows - the other formulas are undefined
+            return [[0] + [''] * (len(STATS_FORMULAS) - 1) for d in data]
 
-        data = s.getvalue()
-        s.close()
+        data = np.vstack(data)
+        means = np.mean(data, axis=1)
+        stds = np.std(data, axis=1)
+        mins = np.min(data, axis=1)
+        quantiles = np.percentile(data, (25, 50, 75), axis=1)
+        maxs = np.max(data, axis=1)
 
-        with open(filename, 'w') as f:
-            f.write(data)
+        return [[count, means[i], stds[i], mins[i], quantiles[0][i], quantiles[1][i], quantiles[2][i], maxs[i]]
+                for i in range(len(data))]
 
     def view_settings(self):
         while True:
@@ -628,14 +3315,26 @@ class App(object):
                 'case_sensitive': 'YES' if self.case_sensitive else 'NO',
                 'csv_path': self.csv_path,
                 'filter_file_path': self.filter_file_path,
-                'out_file_path': self.out_file_path}
+                'out_file_path': self.out_file_path,
+                'workers': self.workers,
+                'engine': self.engine,
+                'use_cache': 'YES' if self.use_cache else 'NO',
+                'incremental': 'YES' if self.incremental else 'NO',
+                'approximate_stats': 'NO'}
+            if self.quantile_error is not None:
+                settings['approximate_stats'] = 'YES (quantile error {0:g})'.format(self.quantile_error)
 
             msg = ('Settings:\n'
                    ' 1) Case Sensitive String Filters             {case_sensitive}\n'
                    ' 2) CSV Input Directory                       {csv_path}\n'
                    ' 3) Filters Input File                        {filter_file_path}\n'
                    ' 4) Results Output File                       {out_file_path}\n'
-                   ' 5) Restore defaults\n\n'
+                   ' 5) Analysis Worker Processes                 {workers}\n'
+                   ' 6) Analysis Engine                           {engine}\n'
+                   ' 7) Cache Parsed CSV Files                    {use_cache}\n'
+                   ' 8) Incremental Re-analysis                   {incremental}\n'
+                   ' 9) Approximate Stats                         {approximate_stats}\n'
+                   '10) Restore defaults\n\n'
                    'Enter a number to edit, or hit RETURN to go back to main menu\n\n')
             msg = msg.format(**settings)
             action = raw_input(msg)
@@ -653,6 +3352,16 @@ class App(object):
                 self.edit_path('filter_file_path', 'Enter the path to the Filters Input File:', True)
             elif action == ACTION_SETTING_EDIT_OUT_PATH:
                 self.edit_path('out_file_path', 'Enter the path to the Results Output File:', True)
+            elif action == ACTION_SETTING_EDIT_WORKERS:
+                self.edit_workers()
+            elif action == ACTION_SETTING_EDIT_ENGINE:
+                self.edit_engine()
+            elif action == ACTION_SETTING_EDIT_CACHE:
+                self.edit_cache()
+            elif action == ACTION_SETTING_EDIT_INCREMENTAL:
+                self.edit_incremental()
+            elif action == ACTION_SETTING_EDIT_APPROXIMATE_STATS:
+                self.edit_approximate_stats()
             elif action == ACTION_SETTING_RESTORE_DEFAULTS:
                 self.restore_defaults()
             else:
@@ -666,7 +3375,12 @@ class App(object):
                             self.csv_path.replace(self.root_path, ''),
                             self.filter_file_path.replace(self.root_path, ''),
                             self.out_file_path.replace(self.root_path, ''),
-                            '1' if self.case_sensitive else '0']
+                            '1' if self.case_sensitive else '0',
+                            str(self.workers),
+                            self.engine,
+                            '1' if self.use_cache else '0',
+                            '1' if self.incremental else '0',
+                            str(self.quantile_error) if self.quantile_error is not None else '']
                 f.writelines('\n'.join(settings))
         except:
             pass
@@ -688,6 +3402,12 @@ class App(object):
                     self.filter_file_path = os.path.join(self.root_path, filter_file_path)
                     self.out_file_path = os.path.join(self.root_path, out_file_path)
                     self.case_sensitive = settings[4].strip() == '1'
+                    self.workers = int(settings[5].strip())
+                    self.engine = settings[6].strip()
+                    self.use_cache = settings[7].strip() == '1'
+                    self.incremental = settings[8].strip() == '1'
+                    if len(settings) > 9 and settings[9].strip():
+                        self.quantile_error = float(settings[9].strip())
         except:
             pass
 
@@ -701,6 +3421,90 @@ class App(object):
         if action.upper() == 'YES':
             self.case_sensitive = not self.case_sensitive
 
+    def edit_workers(self):
+        msg = ('Enter the number of worker processes to analyse CSV files with (1 - {0}):\n'
+               'CSV files are spread across the workers, and files larger than {1} MB are split into chunks\n'
+               'which are analysed by several workers at once.\n').format(multiprocessing.cpu_count(),
+                                                                         self.chunk_size // (1024 * 1024))
+        workers = raw_input(msg)
+
+        try:
+            workers = int(workers)
+        except ValueError:
+            workers = 0
+
+        if workers >= 1:
+            self.workers = workers
+        else:
+            raw_input('Invalid number of workers: must be a whole number of at least 1\n')
+
+    def edit_engine(self):
+        msg = ('The {0} analysis engine is currently selected.\n'
+               'The columnar engine is fastest, but loads the filtered columns of each CSV file into memory.\n'
+               'The streaming engine reads one row at a time, for CSV files too large to fit in memory.\n'
+               'Do you wish to switch to the {1} engine? (YES|NO)\n')
+        other = ENGINE_STREAMING if self.engine == ENGINE_COLUMNAR else ENGINE_COLUMNAR
+        action = raw_input(msg.format(self.engine, other))
+
+        if action.upper() == 'YES':
+            self.engine = other
+
+    def edit_cache(self):
+        msg = ('Caching of parsed CSV files is currently ENABLED.\n'
+               'Cached files are stored in {0}\n'
+               'Do you wish to disable it? (YES|NO)\n')
+        if not self.use_cache:
+            msg = ('Caching of parsed CSV files is currently DISABLED.\n'
+                   'Enabling it speeds up repeated analyses of the same CSV files when using the columnar engine.\n'
+                   'Do you wish to enable it? (YES|NO)\n')
+
+        action = raw_input(msg.format(self.cache_path))
+
+        if action.upper() == 'YES':
+            self.use_cache = not self.use_cache
+
+    def edit_incremental(self):
+        msg = ('Incremental Re-analysis is currently ENABLED.\n'
+               'Do you wish to disable it? (YES|NO)\n')
+        if not self.incremental:
+            msg = ('Incremental Re-analysis is currently DISABLED.\n'
+                   'When enabled, results are only re-calculated for the CSV files and filters which have changed\n'
+                   'since the last analysis saved to the same Results Output File.\n'
+                   'Do you wish to enable it? (YES|NO)\n')
+
+        action = raw_input(msg)
+
+        if action.upper() == 'YES':
+            self.incremental = not self.incremental
+
+    def edit_approximate_stats(self):
+        msg = ('Stats are currently calculated EXACTLY.\n'
+               'Approximate stats are calculated in constant memory, however many rows match a filter.\n'
+               'The count, mean, standard deviation, min and max stay exact, and the quartiles are estimated\n'
+               'to within a rank error, eg. 0.01 for within 1% of the matched rows.\n'
+               'Enter a rank error to enable approximate stats, or hit RETURN to keep exact stats:\n')
+        if self.quantile_error is not None:
+            msg = ('Stats are currently calculated APPROXIMATELY, with the quartiles to within a rank error of {0:g}.\n'
+                   'Enter a new rank error, NO to switch to exact stats, or hit RETURN to keep it:\n')
+
+        action = raw_input(msg.format(self.quantile_error)).strip()
+
+        if not action:
+            return
+        if action.upper() == 'NO':
+            self.quantile_error = None
+            return
+
+        try:
+            quantile_error = float(action)
+        except ValueError:
+            quantile_error = 0
+
+        if 0 < quantile_error < 1:
+            self.quantile_error = quantile_error
+        else:
+            raw_input('Invalid rank error: must be a number between 0 and 1\n')
+
     def edit_path(self, prop, msg, is_file):
         path = raw_input(msg + '\n')
         abs_path = self._get_absolute_path_or_file(path, is_file)
@@ -745,6 +3549,11 @@ class App(object):
             self.csv_path = os.path.join(self.root_path, DEFAULT_IN_DIR)
             self.out_file_path = os.path.join(self.root_path, DEFAULT_OUT_FILE)
             self.filter_file_path = os.path.join(self.root_path, DEFAULT_FILTER_FILE)
+            self.workers = DEFAULT_WORKERS
+            self.engine = DEFAULT_ENGINE
+            self.use_cache = True
+            self.incremental = False
+            self.quantile_error = None
 
     def _get_cell_ref(self, n):
         string = ""
@@ -754,10 +3563,449 @@ class App(object):
         return string
 
 
-def main():
+class ListSink(list):
+    """ collects the rows written to it, in place of a CsvSink """
+
+    def writerow(self, row):
+        self.append(row)
+
+
+class AnalysisServer(object):
+    """ runs count and stats analyses for clients of a local socket - see AnalysisRequestHandler.
+
+        the scanned csv folders, parsed filters, parsed csv columns (see MemoryCache) and recent results are kept
+        in memory between jobs, so a job only parses what the previous ones have not. jobs run concurrently,
+        one thread each, and identical jobs over unchanged csv files are answered from the recent results.
+    """
+
+    def __init__(self, app, memory=DEFAULT_SERVER_MEMORY, max_results=DEFAULT_SERVER_RESULTS):
+        """ Args:
+                app: the App holding the settings jobs are run with
+                memory: the most memory to keep parsed csv files in, in bytes
+                max_results: the number of recent results, and parsed filters, to keep
+        """
+
+        self.app = app
+        self.max_results = max_results
+        self.table_cache = MemoryCache(memory, ColumnCache(app.cache_path, app.cache_size) if app.use_cache else None)
+
+        self.scans = {}  # csv_path: (mtime, csv_filenames)
+        self.filters = collections.OrderedDict()  # filters text: filters, least recently used first
+        self.results = collections.OrderedDict()  # job key: results, least recently used first
+        self.jobs = 0
+        self.results_reused = 0
+        self.lock = threading.Lock()
+
+    def analyse(self, analysis_type, job):
+        """ runs an analysis job
+            Args:
+                analysis_type: ANALYSIS_TYPE_COUNT, ANALYSIS_TYPE_STATS or ANALYSIS_TYPE_COMBINED
+                job: a dict of
+                    filters: the contents of a filters csv file
+                    csv_dir: optional folder of the csv files, instead of the CSV Input Directory
+                    ignore_case: optional, whether to match the strings in filters case insensitively
+                    approximate_stats: optional quantile error for approximate stats - see StatsAccumulator
+            Returns:
+                a dict of the results header and rows, the error log header and rows, and whether
+                the results were reused from an identical job. the header and rows of a combined analysis
+                are those of its counts, and its stats are returned as the stats header and rows.
+            Raises:
+                InvalidJobException: if the job is invalid, or its csv files or filters can not be loaded
+        """
+
+        if analysis_type not in (ANALYSIS_TYPE_COUNT, ANALYSIS_TYPE_STATS, ANALYSIS_TYPE_COMBINED):
+            raise InvalidJobException('Unknown analysis "{0}"'.format(analysis_type), 404)
+
+        app = copy.copy(self.app)
+        app.csv_path = os.path.abspath(job.get('csv_dir') or self.app.csv_path)
+        app.case_sensitive = not job.get('ignore_case', not self.app.case_sensitive)
+        app.quantile_error = job.get('approximate_stats', self.app.quantile_error)
+        if app.quantile_error is not None and not 0 < app.quantile_error < 1:
+            raise InvalidJobException('approximate_stats must be between 0 and 1')
+
+        # jobs share the parsed csv files held in memory, and run in this thread ...
+        app.table_cache = self.table_cache
+        app.workers = 1
+        app.incremental = False
+        app.profiler = Profiler(enabled=False)
+        app.error_count = 0
+
+        app.csv_filenames = self._get_csv_filenames(app.csv_path)
+        app.filters = self._get_filters(app, job.get('filters'))
+
+        key = (analysis_type, app.csv_path, job.get('filters'), app.case_sensitive, app.quantile_error, app.engine,
+               tuple(self.table_cache.get_version(os.path.join(app.csv_path, f.filename)) for f in app.csv_filenames))
+        with self.lock:
+            self.jobs += 1
+            results = self.results.pop(key, None)
+            if results is not None:
+                self.results[key] = results
+                self.results_reused += 1
+                return dict(results, reused=True)
+
+        errors = ListSink()
+        tables = []
+        for csv_file, cells in app._get_filter_results(analysis_type, errors):
+            tables.append(app._get_result_rows(analysis_type, csv_file, cells))
+        # the job may have added bitmaps and sorted indexes to the tables held in memory ...
+        self.table_cache.update_sizes()
+
+        header_type = ANALYSIS_TYPE_COUNT if analysis_type == ANALYSIS_TYPE_COMBINED else analysis_type
+        results = {'header': app._get_results_header(header_type),
+                   'rows': [rows[0] for rows in tables],
+                   'error_header': ERROR_LOG_HEADER,
+                   'errors': errors}
+        if analysis_type == ANALYSIS_TYPE_COMBINED:
+            results['stats_header'] = app._get_results_header(ANALYSIS_TYPE_STATS)
+            results['stats_rows'] = [rows[1] for rows in tables]
+
+        with self.lock:
+            self.results[key] = results
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+        return dict(results, reused=False)
+
+    def get_status(self):
+        with self.lock:
+            return {'jobs': self.jobs,
+                    'results_reused': self.results_reused,
+                    'results': len(self.results),
+                    'csv_folders': len(self.scans),
+                    'filters': len(self.filters),
+                    'memory_cache': self.table_cache.get_status()}
+
+    def _get_csv_filenames(self, csv_path):
+        """ returns the CsvFiles of a csv folder, scanning it again only if its contents have changed """
+
+        try:
+            mtime = os.path.getmtime(csv_path)
+        except OSError:
+            raise InvalidJobException('CSV folder not found: {0}'.format(csv_path))
+
+        with self.lock:
+            scan = self.scans.get(csv_path)
+        if scan is not None and scan[0] == mtime and not self.app.recursive:
+            # (changes to sub folders do not change the mtime of the folder) ...
+            return scan[1]
+
+        app = copy.copy(self.app)
+        app.csv_path = csv_path
+        try:
+            app._scan_for_csvs()
+        except DuplicateCsvNumException, e:
+            raise InvalidJobException('Duplicate number "{0}" found in "{1}" and "{2}"'.format(e.num, e.fn1, e.fn2))
+
+        if not app.csv_filenames:
+            raise InvalidJobException('No CSV files with the pattern "{0}" found in {1}'.format(CSV_PATTERN, csv_path))
+
+        with self.lock:
+            self.scans[csv_path] = (mtime, app.csv_filenames)
+        return app.csv_filenames
+
+    def _get_filters(self, app, text):
+        """ returns the parsed filters of the contents of a filters csv file, parsing them only if they are new """
+
+        if not isinstance(text, basestring):
+            raise InvalidJobException('filters must be the contents of a filters csv file')
+
+        with self.lock:
+            filters = self.filters.pop(text, None)
+            if filters is not None:
+                self.filters[text] = filters
+                return filters
+
+        try:
+            filters = app._parse_filters(csv.reader(cStringIO.StringIO(text.encode('utf-8')), dialect=csv.excel))
+        except (InvalidFilterOperatorException, InvalidFilterValueException), e:
+            raise InvalidJobException('Invalid filter in cell {0}: {1}'.format(e.cell, e.condition))
+
+        if not filters:
+            raise InvalidJobException('No filters found')
+
+        with self.lock:
+            self.filters[text] = filters
+            while len(self.filters) > self.max_results:
+                self.filters.popitem(last=False)
+        return filters
+
+
+class AnalysisRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ the http api of the AnalysisServer:
+            POST /count, /stats or /combined with a json job - see AnalysisServer.analyse. responds with the json results.
+            GET /status responds with the number of jobs run, and the size of the caches.
+        errors are responded to with a json object holding the error message.
+    """
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            job = json.loads(self.rfile.read(length) or '{}')
+        except ValueError:
+            job = None
+        if not isinstance(job, dict):
+            self._respond(400, {'error': 'The request must be a json object'})
+            return
+
+        try:
+            results = self.server.analysis_server.analyse(self.path.strip('/'), job)
+        except InvalidJobException, e:
+            self._respond(e.status, {'error': e.message})
+        except Exception, e:
+            self.log_error('%s', traceback.format_exc())
+            self._respond(500, {'error': str(e)})
+        else:
+            self._respond(200, results)
+
+    def do_GET(self):
+        if self.path.strip('/') == 'status':
+            self._respond(200, self.server.analysis_server.get_status())
+        else:
+            self._respond(404, {'error': 'Not found'})
+
+    def address_string(self):
+        if not isinstance(self.client_address, tuple):
+            # connected to the unix socket ...
+            return 'local'
+        return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            sys.stderr.write('{0} - - [{1}] {2}\n'.format(self.address_string(), self.log_date_time_string(),
+                                                         format % args))
+
+    def _respond(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(analysis_server, port=DEFAULT_SERVER_PORT, socket_path=None, quiet=False):
+    """ answers analysis jobs on localhost:port, or the unix socket at socket_path, until interrupted """
+
+    if socket_path is not None:
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            # left behind by a previous server ...
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, AnalysisRequestHandler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), AnalysisRequestHandler)
+
+    server.analysis_server = analysis_server
+    server.quiet = quiet
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def batch_main(argv):
+    """ runs an analysis (or conversion) from the command line, with no prompts.
+        returns one of the EXIT_* codes.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Counts (or calculates stats for) the rows of a collection of csv files matching a set of filters. '
+                    'Run with no arguments for the interactive menu.')
+    parser.add_argument('action',
+                        choices=(ANALYSIS_TYPE_COUNT, ANALYSIS_TYPE_STATS, ANALYSIS_TYPE_COMBINED,
+                                 BATCH_ACTION_CONVERT, BATCH_ACTION_SERVE),
+                        help='the analysis to perform ("combined" writes the counts to the results file, and the '
+                             'stats alongside it with a "{0}" suffix), "convert" to convert the csv files to the '
+                             'columnar format, or "serve" to answer analysis jobs over http - see '
+                             'AnalysisRequestHandler'.format(STATS_OUT_FILE_SUFFIX))
+    parser.add_argument('--csv-dir', help='the folder containing the csv files (default: {0})'.format(DEFAULT_IN_DIR))
+    parser.add_argument('--filters', help='the filters csv file (default: {0})'.format(DEFAULT_FILTER_FILE))
+    parser.add_argument('--output', help='the results csv file to write (default: {0})'.format(DEFAULT_OUT_FILE))
+    parser.add_argument('--errors', help='the errors csv file to write (default: {0} in the same folder as '
+                                         'the results)'.format(DEFAULT_ERROR_FILE))
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='number of worker processes (default: {0})'.format(DEFAULT_WORKERS))
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='with more than one worker, files larger than this many bytes are split into chunks '
+                             'which are analysed in parallel (default: {0})'.format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument('--prefetch', type=int, default=DEFAULT_PREFETCH,
+                        help='with one worker, read this many csv files ahead of their analysis, or 0 to not read '
+                             'ahead (default: {0})'.format(DEFAULT_PREFETCH))
+    parser.add_argument('--prefetch-memory', type=int, default=DEFAULT_PREFETCH_MEMORY / (1024 * 1024), metavar='MB',
+                        help='the most memory held by the blocks of csv files read ahead (default: {0})'.format(
+                            DEFAULT_PREFETCH_MEMORY / (1024 * 1024)))
+    parser.add_argument('--engine', choices=(ENGINE_COLUMNAR, ENGINE_STREAMING), default=DEFAULT_ENGINE,
+                        help='analysis engine (default: {0})'.format(DEFAULT_ENGINE))
+    parser.add_argument('--ignore-case', action='store_true', help='match the strings in filters case insensitively')
+    parser.add_argument('--approximate-stats', metavar='ERROR', type=float, nargs='?', const=DEFAULT_QUANTILE_ERROR,
+                        help='calculate stats in constant memory, with the quartiles estimated to within a rank error '
+                             'of ERROR (default: {0:g})'.format(DEFAULT_QUANTILE_ERROR))
+    parser.add_argument('--no-cache', action='store_true', help='do not use (or update) the parsed csv cache')
+    parser.add_argument('--cache-dir', help='the parsed csv cache folder (default: ~/{0})'.format(DEFAULT_CACHE_DIR))
+    parser.add_argument('--incremental', action='store_true',
+                        help='only re-analyse the files and filters which have changed since the last run '
+                             'with the same --output')
+    parser.add_argument('--recursive', action='store_true', help='also find csv files in sub folders of --csv-dir')
+    parser.add_argument('--watch', action='store_true',
+                        help='count / stats: after the analysis, keep watching for new or changed csv files, '
+                             'and update the results with them until interrupted')
+    parser.add_argument('--watch-interval', type=float, default=DEFAULT_WATCH_INTERVAL, metavar='SECONDS',
+                        help='watch: seconds between checks for new or changed csv files (default: {0})'.format(
+                            DEFAULT_WATCH_INTERVAL))
+    parser.add_argument('--settle-time', type=float, default=DEFAULT_WATCH_SETTLE_TIME, metavar='SECONDS',
+                        help='watch: seconds a csv file must go unchanged before it is analysed (default: {0})'.format(
+                            DEFAULT_WATCH_SETTLE_TIME))
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVER_PORT,
+                        help='serve: the localhost port to listen on (default: {0})'.format(DEFAULT_SERVER_PORT))
+    parser.add_argument('--socket', help='serve: listen on this unix socket, rather than a port')
+    parser.add_argument('--server-memory', type=int, default=DEFAULT_SERVER_MEMORY / (1024 * 1024), metavar='MB',
+                        help='serve: the most memory to keep parsed csv files in (default: {0})'.format(
+                            DEFAULT_SERVER_MEMORY / (1024 * 1024)))
+    parser.add_argument('--quiet', action='store_true', help='only print errors')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='save a json report of the time, memory and rows of each phase and file to REPORT')
+    parser.add_argument('--profile-dump', metavar='DUMP',
+                        help='profile the run with cProfile, and save the stats (pstats format) to DUMP')
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.prefetch < 0 or args.prefetch_memory < 0:
+        parser.error('--prefetch and --prefetch-memory can not be negative')
+    if args.approximate_stats is not None and not 0 < args.approximate_stats < 1:
+        parser.error('--approximate-stats must be between 0 and 1')
+
+    app = App()
+
+    # ignore the saved settings of the interactive app, so batch runs only depend on their arguments ...
+    app.csv_path = os.path.abspath(args.csv_dir) if args.csv_dir else os.path.join(app.root_path, DEFAULT_IN_DIR)
+    app.filter_file_path = (os.path.abspath(args.filters) if args.filters
+                            else os.path.join(app.root_path, DEFAULT_FILTER_FILE))
+    app.out_file_path = os.path.abspath(args.output) if args.output else os.path.join(app.root_path, DEFAULT_OUT_FILE)
+    app.error_log_file_path = (os.path.abspath(args.errors) if args.errors
+                               else os.path.join(os.path.dirname(app.out_file_path), DEFAULT_ERROR_FILE))
+    app.workers = args.workers
+    app.chunk_size = args.chunk_size
+    app.prefetch = args.prefetch
+    app.prefetch_memory = args.prefetch_memory * 1024 * 1024
+    app.engine = args.engine
+    app.use_cache = not args.no_cache
+    if args.cache_dir:
+        app.cache_path = os.path.abspath(args.cache_dir)
+    app.incremental = args.incremental or args.watch
+    app.recursive = args.recursive
+    app.case_sensitive = not args.ignore_case
+    app.quantile_error = args.approximate_stats
+    if args.profile or args.profile_dump:
+        app.profiler = Profiler(dump_path=os.path.abspath(args.profile_dump) if args.profile_dump else None)
+
+    def log(msg):
+        if not args.quiet:
+            print msg
+
+    if args.action == BATCH_ACTION_SERVE:
+        log('Serving analyses of {0} on {1} - hit Ctrl+C to stop'.format(
+            app.csv_path, args.socket or 'http://127.0.0.1:{0}/'.format(args.port)))
+        serve(AnalysisServer(app, args.server_memory * 1024 * 1024), args.port, args.socket, args.quiet)
+        return EXIT_OK
+
+    try:
+        app._scan_for_csvs()
+    except OSError:
+        sys.stderr.write('Error: CSV folder not found: {0}\n'.format(app.csv_path))
+        return EXIT_INPUT_ERROR
+    except DuplicateCsvNumException, e:
+        sys.stderr.write('Error: duplicate number "{0}" found in "{1}" and "{2}"\n'.format(e.num, e.fn1, e.fn2))
+        return EXIT_INPUT_ERROR
+
+    if not app.csv_filenames:
+        sys.stderr.write('Error: no CSV files with the pattern "{0}" found in {1}\n'.format(CSV_PATTERN, app.csv_path))
+        return EXIT_INPUT_ERROR
+    log('Found {0} CSV files in {1}'.format(len(app.csv_filenames), app.csv_path))
+
+    if args.action == BATCH_ACTION_CONVERT:
+        with app.profiler.phase('_convert_csvs'):
+            for csv_file in app._convert_csvs():
+                log(' converted {0}\t{1}'.format(csv_file.num_str, csv_file.filename))
+        app.profiler.save(os.path.abspath(args.profile) if args.profile else None)
+        return EXIT_OK
+
+    try:
+        app._scan_for_filters()
+    except IOError:
+        sys.stderr.write('Error: filters file not found: {0}\n'.format(app.filter_file_path))
+        return EXIT_INPUT_ERROR
+    except (InvalidFilterOperatorException, InvalidFilterValueException), e:
+        sys.stderr.write('Error: invalid filter in cell {0}: {1}\n'.format(e.cell, e.condition))
+        return EXIT_INPUT_ERROR
+
+    if not app.filters:
+        sys.stderr.write('Error: no filters found in {0}\n'.format(app.filter_file_path))
+        return EXIT_INPUT_ERROR
+    log('Found {0} filters in {1}'.format(len(app.filters), app.filter_file_path))
+
+    out_paths = app._get_out_file_paths(args.action)
+    for path in out_paths + [app.error_log_file_path]:
+        if not os.path.isdir(os.path.dirname(path)):
+            sys.stderr.write('Error: output folder not found: {0}\n'.format(os.path.dirname(path)))
+            return EXIT_OUTPUT_ERROR
+
+    try:
+        app._do_analysis(args.action)
+    except IOError, e:
+        if e.filename is None or not e.filename.startswith(tuple(out_paths + [app.error_log_file_path])):
+            raise
+        sys.stderr.write('Error: could not write the results: {0}\n'.format(e))
+        return EXIT_OUTPUT_ERROR
+
+    app.profiler.save(os.path.abspath(args.profile) if args.profile else None)
+
+    log('Analysis complete with {0} errors\nResults have been saved to {1}'.format(
+        app.error_count, ' and '.join(out_paths)))
+    if args.profile:
+        log('Profile report has been saved to {0}'.format(args.profile))
+    if app.error_count:
+        log('Errors have been logged in {0}'.format(app.error_log_file_path))
+
+    if args.watch:
+        log('Watching {0} for new or changed CSV files - hit Ctrl+C to stop'.format(app.csv_path))
+        try:
+            app._watch(args.action, args.watch_interval, args.settle_time, log,
+                       lambda msg: sys.stderr.write('Error: {0}\n'.format(msg)))
+        except KeyboardInterrupt:
+            pass
+
+    if app.error_count:
+        return EXIT_ANALYSIS_ERRORS
+    return EXIT_OK
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv:
+        # a crash must not be mistaken for an analysis which completed with errors logged ...
+        try:
+            return batch_main(argv)
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+            return EXIT_INTERNAL_ERROR
+
     app = App()
     app.run()
+    return EXIT_OK
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
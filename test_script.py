@@ -0,0 +1,940 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+""" tests of script.py - mostly checking that every way it can analyse a set of csv files gives the same results
+    and error log as evaluating the filters against each row in turn, in filter order.
+
+    Usage: python -m unittest test_script
+"""
+
+import collections
+import contextlib
+import cStringIO
+import csv
+import gzip
+import httplib
+import json
+import mmap
+import os
+import pstats
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+import script
+
+
+FILTERS = (
+    'Count,>= 10,>=30,>=5,>=5',
+    'Coverage,>=10,>=100,>=10,<300',
+    'Forward read count,>=5,>=10,>3,IGNORE',
+    'Reverse read count,>=5,>=10,IGNORE,IGNORE',
+    'dbSNP,BLANK,BLANK,IGNORE,IGNORE',
+    'Type,"Deletion,Insertion,MNV","Deletion,MNV",IGNORE,SNV',
+    'Frequency,>=2.5,IGNORE,<=80,IGNORE',
+    'Non-synonymous,"Yes,No,-","Yes,-",IGNORE,IGNORE')
+
+HEADERS = ('Chromosome', 'Region', 'Type', 'Count', 'Coverage', 'Frequency', 'Forward read count',
+           'Reverse read count', 'Read count', 'dbSNP', 'Non-synonymous', 'Notes')
+
+# rows per fixture file, and the bytes per chunk when files are split across workers
+ROWS = 1500
+CHUNK_SIZE = 20000
+
+INVALID_NUMBERS = ('n/a', '', '1.2.3', 'abc')
+TYPES = ('SNV', 'snv', 'SNV', 'Deletion', 'deletion', 'MNV', 'Insertion', 'INSERTION')
+NON_SYNONYMOUS = ('Yes', 'yes', 'No', '-')
+
+
+def write_fixture(fn, headers, seed, lineterminator='\n', compress=False, ragged=False):
+    """ writes a csv file of random variants, with some invalid numbers, mixed case strings and quoted fields
+        holding commas and line breaks. if ragged is set, some rows have fewer fields than the header.
+    """
+
+    r = random.Random(seed)
+    f = gzip.open(fn, 'wb') if compress else open(fn, 'wb')
+    with contextlib.closing(f):
+        writer = csv.writer(f, lineterminator=lineterminator)
+        writer.writerow(headers)
+        for x in range(ROWS):
+            coverage = r.randint(1, 400)
+            count = r.randint(0, coverage)
+            forward = r.randint(0, count)
+            row = {'Chromosome': str(r.randint(1, 22)),
+                   'Region': str(r.randint(1, 10 ** 6)),
+                   'Type': r.choice(TYPES),
+                   'Count': str(count),
+                   'Coverage': str(coverage),
+                   'Frequency': '{0:.2f}'.format(100.0 * count / coverage),
+                   'Forward read count': str(forward),
+                   'Reverse read count': str(count - forward),
+                   'Read count': str(count),
+                   'dbSNP': r.choice(('', '', 'rs{0}'.format(r.randint(1, 1000)))),
+                   'Non-synonymous': r.choice(NON_SYNONYMOUS),
+                   'Notes': r.choice(('', '', '', 'note, with comma', 'multi\nline', 'said "hi"'))}
+            for field in ('Count', 'Coverage', 'Frequency', 'Forward read count'):
+                if r.random() < 0.02:
+                    row[field] = r.choice(INVALID_NUMBERS)
+            row = [row[h] for h in headers]
+            if ragged and r.random() < 0.02:
+                # a blank line, or a truncated row - which may end in a quoted field ...
+                row = row[:r.randint(0, len(headers) - 2)]
+                if row and r.random() < 0.5:
+                    row.append('multi\nline, "quoted"')
+            writer.writerow(row)
+
+
+@contextlib.contextmanager
+def patched(**constants):
+    """ sets constants of the script module for the duration of the block """
+
+    saved = dict((name, getattr(script, name)) for name in constants)
+    for name, value in constants.items():
+        setattr(script, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(script, name, value)
+
+
+@contextlib.contextmanager
+def recording_analyses():
+    """ yields a list of the (filename, number of filters) of each file analysed in the block by a single worker """
+
+    analysed = []
+    analyse_csv_file = script._analyse_csv_file
+
+    def record(args):
+        analysed.append((args[1].filename, len(args[0].filters)))
+        return analyse_csv_file(args)
+
+    with patched(_analyse_csv_file=record):
+        yield analysed
+
+
+def get_app(csv_path, filter_file_path, out_path, **settings):
+    """ returns an App analysing the csv files in csv_path with a single worker and no cache, writing its results
+        and error log to out_path, with the given settings
+    """
+
+    app = script.App()
+    app.csv_path = csv_path
+    app.filter_file_path = filter_file_path
+    app.out_file_path = os.path.join(out_path, 'results.csv')
+    app.error_log_file_path = os.path.join(out_path, 'errors.csv')
+    app.workers = 1
+    app.chunk_size = script.DEFAULT_CHUNK_SIZE
+    app.prefetch = 0
+    app.prefetch_memory = script.DEFAULT_PREFETCH_MEMORY
+    app.engine = script.ENGINE_STREAMING
+    app.use_cache = False
+    app.cache_path = os.path.join(out_path, 'cache')
+    app.incremental = False
+    app.recursive = False
+    app.case_sensitive = True
+    app.quantile_error = None
+    for setting, value in settings.items():
+        setattr(app, setting, value)
+    return app
+
+
+class EquivalenceTest(unittest.TestCase):
+    """ compares the results, stats and error log of each analysis with those of the streaming engine analysing
+        the files in turn, with the conditions of each filter evaluated in filter order
+    """
+
+    ragged = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp(prefix='csv-analysis-test-')
+        cls.csv_path = os.path.join(cls.path, 'csv')
+        os.mkdir(cls.csv_path)
+
+        write_fixture(os.path.join(cls.csv_path, 'test_001_g1_.csv'), HEADERS, 1, ragged=cls.ragged)
+        # a missing column, so the filters using it are skipped ...
+        write_fixture(os.path.join(cls.csv_path, 'test_002_g1_.csv'), [h for h in HEADERS if h != 'dbSNP'], 2,
+                      ragged=cls.ragged)
+        write_fixture(os.path.join(cls.csv_path, 'test_003_g1_.csv'), HEADERS, 3, lineterminator='\r\n',
+                      ragged=cls.ragged)
+        write_fixture(os.path.join(cls.csv_path, 'test_004_g1_.csv.gz'), HEADERS, 4, compress=True,
+                      ragged=cls.ragged)
+
+        cls.filter_file_path = os.path.join(cls.path, 'filters.csv')
+        with open(cls.filter_file_path, 'w') as f:
+            f.write('\n'.join(FILTERS))
+
+        with patched(ORDER_SAMPLE_ROWS=0):
+            cls.expected = cls.analyse('expected')
+            cls.expected_ignore_case = cls.analyse('expected_ignore_case', case_sensitive=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path, ignore_errors=True)
+
+    @classmethod
+    def analyse(cls, name, csv_path=None, **settings):
+        """ runs a combined count and stats analysis with the given App settings
+            Returns:
+                a tuple of the contents of the results, stats and error log files
+        """
+
+        # the output of an analysis with the same name is replaced, as a re-run would ...
+        out_path = os.path.join(cls.path, name)
+        if not os.path.isdir(out_path):
+            os.mkdir(out_path)
+
+        app = get_app(csv_path or cls.csv_path, settings.pop('filter_file_path', cls.filter_file_path), out_path,
+                      **settings)
+        app._scan_for_csvs()
+        app._scan_for_filters()
+        app._do_combined_analysis()
+
+        contents = []
+        for path in app._get_out_file_paths(script.ANALYSIS_TYPE_COMBINED) + [app.error_log_file_path]:
+            with open(path, 'rb') as f:
+                contents.append(f.read())
+        return tuple(contents)
+
+    def assertExpected(self, actual, expected=None):
+        expected = expected or self.expected
+        for name, actual_contents, expected_contents in zip(('results', 'stats', 'errors'), actual, expected):
+            self.assertEqual(actual_contents, expected_contents, '{0} differ'.format(name))
+
+    def test_fixtures(self):
+        messages = set(row[2] for row in csv.reader(self.expected[2].splitlines()))
+        self.assertIn(script.INVALID_DATA_MESSAGE, messages)
+        self.assertIn(script.MISSING_FIELD_MESSAGE.format('dbSNP'), messages)
+        self.assertNotEqual(self.expected, self.expected_ignore_case)
+
+    def test_columnar(self):
+        self.assertExpected(self.analyse('columnar', engine=script.ENGINE_COLUMNAR))
+
+    def test_cached(self):
+        cache_path = os.path.join(self.path, 'cache')
+        # the first analysis parses the files into the cache, and the second loads them from it ...
+        for name in ('cached_cold', 'cached_warm'):
+            self.assertExpected(self.analyse(name, engine=script.ENGINE_COLUMNAR, use_cache=True,
+                                             cache_path=cache_path))
+        self.assertTrue(os.listdir(cache_path))
+
+    def test_converted(self):
+        csv_path = os.path.join(self.path, 'converted_csv')
+        shutil.copytree(self.csv_path, csv_path)
+
+        app = script.App()
+        app.csv_path = csv_path
+        app.workers = 1
+        app.recursive = False
+        app._scan_for_csvs()
+        list(app._convert_csvs())
+
+        self.assertExpected(self.analyse('converted', csv_path, engine=script.ENGINE_COLUMNAR))
+
+    def test_chunked_workers(self):
+        for engine in (script.ENGINE_STREAMING, script.ENGINE_COLUMNAR):
+            self.assertExpected(self.analyse('chunked_' + engine, engine=engine, workers=3, chunk_size=CHUNK_SIZE))
+
+    def test_prefetch(self):
+        # small blocks and little memory, so files are read ahead in several blocks, and wait for room ...
+        with patched(PREFETCH_BLOCK_SIZE=1000):
+            for engine in (script.ENGINE_STREAMING, script.ENGINE_COLUMNAR):
+                self.assertExpected(self.analyse('prefetch_' + engine, engine=engine, prefetch=2,
+                                                 prefetch_memory=3000))
+
+    def test_ignore_case(self):
+        for engine in (script.ENGINE_STREAMING, script.ENGINE_COLUMNAR):
+            self.assertExpected(self.analyse('ignore_case_' + engine, engine=engine, case_sensitive=False),
+                                self.expected_ignore_case)
+            self.assertExpected(self.analyse('ignore_case_chunked_' + engine, engine=engine, case_sensitive=False,
+                                             workers=3, chunk_size=CHUNK_SIZE), self.expected_ignore_case)
+
+        # the cached columns are the same for both ...
+        cache_path = os.path.join(self.path, 'ignore_case_cache')
+        self.assertExpected(self.analyse('ignore_case_cold', engine=script.ENGINE_COLUMNAR, use_cache=True,
+                                         cache_path=cache_path))
+        self.assertExpected(self.analyse('ignore_case_warm', engine=script.ENGINE_COLUMNAR, use_cache=True,
+                                         cache_path=cache_path, case_sensitive=False), self.expected_ignore_case)
+
+    def test_reordered_conditions(self):
+        # conditions are reordered many times per file, on short samples ...
+        with patched(ORDER_SAMPLE_ROWS=10, ORDER_SAMPLE_INTERVAL=100):
+            self.assertExpected(self.analyse('reordered'))
+            self.assertExpected(self.analyse('reordered_ignore_case', case_sensitive=False),
+                                self.expected_ignore_case)
+
+    def test_incremental(self):
+        csv_path = os.path.join(self.path, 'incremental_csv')
+        shutil.copytree(self.csv_path, csv_path)
+        self.assertExpected(self.analyse('incremental', csv_path, incremental=True))
+
+        # nothing has changed, so every cell is reused ...
+        with recording_analyses() as analysed:
+            self.assertExpected(self.analyse('incremental', csv_path, incremental=True))
+        self.assertEqual(analysed, [])
+
+        # only the changed filter is analysed ...
+        filter_file_path = os.path.join(self.path, 'incremental_filters.csv')
+        with open(filter_file_path, 'w') as f:
+            f.write('\n'.join(FILTERS).replace('<300', '<250'))
+        with recording_analyses() as analysed:
+            actual = self.analyse('incremental', csv_path, incremental=True, filter_file_path=filter_file_path)
+        self.assertExpected(actual, self.analyse('incremental_filter_fresh', csv_path,
+                                                 filter_file_path=filter_file_path))
+        self.assertEqual(set(n for filename, n in analysed), set([1]))
+
+        # and only the changed file ...
+        write_fixture(os.path.join(csv_path, 'test_001_g1_.csv'), HEADERS, 5, ragged=self.ragged)
+        with recording_analyses() as analysed:
+            actual = self.analyse('incremental', csv_path, incremental=True, filter_file_path=filter_file_path)
+        self.assertExpected(actual, self.analyse('incremental_file_fresh', csv_path,
+                                                 filter_file_path=filter_file_path))
+        self.assertEqual([filename for filename, n in analysed], ['test_001_g1_.csv'])
+
+
+class RaggedRowsTest(EquivalenceTest):
+    """ runs each analysis of EquivalenceTest on files with rows which have fewer fields than the header,
+        which every analysis skips and logs once per file
+    """
+
+    ragged = True
+
+    def test_ragged_rows(self):
+        errors = [row for row in csv.reader(self.expected[2].splitlines()) if row[2] == script.RAGGED_ROW_MESSAGE]
+        self.assertEqual(len(errors), 4)
+        for row in errors:
+            self.assertTrue(row[4].startswith('Row '), row)
+
+
+class RecordStartsTest(unittest.TestCase):
+    """ checks that files are only split between records, by parsing the text either side of each split """
+
+    FIELDS = ('a', '12', '', '"quoted, with comma"', '"multi\nline"', '"escaped "" quote"', '""""', '5" disk',
+              'a""b', '"ends with ""\n"""')
+
+    def test_record_starts(self):
+        r = random.Random(7)
+        analyser = script.CsvAnalyser.__new__(script.CsvAnalyser)
+        for x in range(200):
+            lineterminator = r.choice(('\n', '\r\n'))
+            text = ''.join(','.join(r.choice(self.FIELDS) for y in range(r.randint(1, 4))) + lineterminator
+                           for z in range(r.randint(1, 30)))
+            rows = list(csv.reader(text.splitlines(True)))
+
+            with tempfile.TemporaryFile() as f:
+                f.write(text)
+                f.flush()
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # small blocks, so quoted fields span several of them ...
+                with patched(QUOTE_SCAN_BLOCK_SIZE=r.randint(1, 50)):
+                    starts = analyser._find_record_starts(m, range(0, len(text), r.randint(1, 40)))
+                m.close()
+
+            self.assertTrue(starts)
+            for start in starts:
+                head = list(csv.reader(text[:start].splitlines(True)))
+                tail = list(csv.reader(text[start:].splitlines(True)))
+                self.assertEqual(head + tail, rows, repr((text, start)))
+
+
+class PrefetcherTest(unittest.TestCase):
+    """ checks files read ahead in blocks have the same lines as when opened with open_csv """
+
+    TEXTS = ('a,b\r\n1,2\r\n"multi\r\nline",3\r\n', 'a,b\r1,2\r3,4', 'a,b\n\n1,2\n', '')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='csv-analysis-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_lines(self):
+        filenames = []
+        for x, text in enumerate(self.TEXTS * 2):
+            fn = os.path.join(self.path, 'test_{0:03d}.csv'.format(x))
+            if x % 2:
+                fn += '.gz'
+            with contextlib.closing(gzip.open(fn, 'wb') if x % 2 else open(fn, 'wb')) as f:
+                f.write(text)
+            filenames.append(fn)
+
+        # tiny blocks, so \r\n newlines fall across blocks, and a budget of a few blocks ...
+        with patched(PREFETCH_BLOCK_SIZE=3):
+            prefetcher = script.Prefetcher(filenames + [None], 2, 10)
+            try:
+                for x, fn in enumerate(filenames):
+                    with script.open_csv(fn) as f:
+                        expected = list(f)
+                    with contextlib.closing(prefetcher.get(x)) as lines:
+                        self.assertEqual(list(lines), expected, fn)
+                self.assertIsNone(prefetcher.get(len(filenames)))
+            finally:
+                prefetcher.close()
+
+    def test_missing_file(self):
+        prefetcher = script.Prefetcher([os.path.join(self.path, 'missing.csv')], 1, 10)
+        try:
+            with self.assertRaises(IOError):
+                list(prefetcher.get(0))
+        finally:
+            prefetcher.close()
+
+
+class IncrementalStateTest(unittest.TestCase):
+    """ checks the keys of the cells saved by incremental analyses """
+
+    def test_filter_keys(self):
+        state = script.IncrementalState('unused.state.json')
+        condition = {'field': 'Count', 'op': '>=', 'vals': ['10']}
+        # the key of a filter does not depend on the order of the keys of its conditions ...
+        reordered = collections.OrderedDict(sorted(condition.items(), reverse=True))
+        self.assertEqual(state.get_key(script.ANALYSIS_TYPE_COUNT, 'hash', [condition], True),
+                         state.get_key(script.ANALYSIS_TYPE_COUNT, 'hash', [reordered], True))
+
+
+class BatchTest(unittest.TestCase):
+    """ checks the exit code of each outcome of a batch run from the command line """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='csv-analysis-test-')
+        self.csv_path = os.path.join(self.path, 'csv')
+        os.mkdir(self.csv_path)
+        with open(os.path.join(self.csv_path, 'test_001_g1_.csv'), 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADERS)
+            writer.writerow(['1', '100', 'SNV', '20', '200', '10.0', '10', '10', '20', '', 'Yes', ''])
+
+        self.filter_file_path = os.path.join(self.path, 'filters.csv')
+        with open(self.filter_file_path, 'w') as f:
+            f.write('\n'.join(FILTERS))
+        self.out_file_path = os.path.join(self.path, 'results.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def run_batch(self, *args):
+        """ runs a count analysis of the test files with the given extra arguments, and returns the exit code """
+
+        argv = ['count', '--csv-dir', self.csv_path, '--filters', self.filter_file_path, '--output', self.out_file_path,
+                '--no-cache', '--quiet'] + list(args)
+        stderr = sys.stderr
+        sys.stderr = cStringIO.StringIO()
+        try:
+            return script.main(argv)
+        except SystemExit, e:
+            # argparse exits on usage errors ...
+            return e.code
+        finally:
+            sys.stderr = stderr
+
+    def test_ok(self):
+        self.assertEqual(self.run_batch(), script.EXIT_OK)
+        with open(self.out_file_path, 'rb') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[1][2:], ['0', '0', '1', '1'])
+        self.assertFalse(os.path.exists(os.path.join(self.path, script.DEFAULT_ERROR_FILE)))
+
+    def test_profile(self):
+        report_path = os.path.join(self.path, 'profile.json')
+        dump_path = os.path.join(self.path, 'profile.pstats')
+        self.assertEqual(self.run_batch('--profile', report_path, '--profile-dump', dump_path), script.EXIT_OK)
+
+        with open(report_path, 'r') as f:
+            report = json.load(f)
+        self.assertEqual([phase['name'] for phase in report['phases']],
+                         ['_scan_for_csvs', '_scan_for_filters', '_do_count_analysis'])
+        self.assertEqual(report['rows_read'], 1)
+
+        entry, = report['files']
+        self.assertEqual(entry['file'], 'test_001_g1_.csv')
+        self.assertEqual([e['rows_matched'] for e in entry['filters']], [0, 0, 1, 1])
+        self.assertFalse(any(e['reused'] for e in entry['filters']))
+
+        stats = pstats.Stats(dump_path)
+        self.assertTrue(stats.total_calls)
+
+    def test_analysis_errors(self):
+        write_fixture(os.path.join(self.csv_path, 'test_002_g1_.csv'), HEADERS, 1)
+        self.assertEqual(self.run_batch(), script.EXIT_ANALYSIS_ERRORS)
+        self.assertTrue(os.path.exists(os.path.join(self.path, script.DEFAULT_ERROR_FILE)))
+
+    def test_usage(self):
+        self.assertEqual(self.run_batch('--workers', '0'), script.EXIT_USAGE)
+        self.assertEqual(self.run_batch('--engine', 'unknown'), script.EXIT_USAGE)
+
+    def test_input_error(self):
+        self.assertEqual(self.run_batch('--csv-dir', os.path.join(self.path, 'missing')), script.EXIT_INPUT_ERROR)
+        self.assertEqual(self.run_batch('--filters', os.path.join(self.path, 'missing.csv')), script.EXIT_INPUT_ERROR)
+
+        with open(self.filter_file_path, 'w') as f:
+            f.write('Count,>>10')
+        self.assertEqual(self.run_batch(), script.EXIT_INPUT_ERROR)
+
+    def test_output_error(self):
+        out_file_path = os.path.join(self.path, 'missing', 'results.csv')
+        self.assertEqual(self.run_batch('--output', out_file_path), script.EXIT_OUTPUT_ERROR)
+
+    def test_internal_error(self):
+        def fail(args):
+            raise RuntimeError('crashed')
+
+        with patched(_analyse_csv_file=fail):
+            self.assertEqual(self.run_batch('--prefetch', '0'), script.EXIT_INTERNAL_ERROR)
+        # the previous results are kept ...
+        self.assertFalse(os.path.exists(self.out_file_path))
+
+
+class CsvSinkTest(unittest.TestCase):
+    """ checks a CsvSink only replaces its file once it is closed """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='csv-analysis-test-')
+        self.fn = os.path.join(self.path, 'results.csv')
+        with open(self.fn, 'wb') as f:
+            f.write('old\r\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def read(self):
+        with open(self.fn, 'rb') as f:
+            return f.read()
+
+    def test_replace(self):
+        with script.CsvSink(self.fn, ('a', 'b')) as sink:
+            sink.writerow((1, 'x, y'))
+            self.assertEqual(self.read(), 'old\r\n')
+        self.assertEqual(self.read(), 'a,b\r\n1,"x, y"\r\n')
+        self.assertEqual(os.listdir(self.path), ['results.csv'])
+
+    def test_abort(self):
+        with self.assertRaises(RuntimeError):
+            with script.CsvSink(self.fn, ('a', 'b')) as sink:
+                sink.writerow((1, 2))
+                raise RuntimeError('failed')
+        self.assertEqual(self.read(), 'old\r\n')
+        self.assertEqual(os.listdir(self.path), ['results.csv'])
+
+    def test_header_only(self):
+        with script.CsvSink(self.fn, ('a', 'b')):
+            pass
+        self.assertEqual(self.read(), 'a,b\r\n')
+
+    def test_remove_if_empty(self):
+        with script.CsvSink(self.fn, ('a', 'b'), remove_if_empty=True) as sink:
+            sink.writerow((1, 2))
+        self.assertEqual(self.read(), 'a,b\r\n1,2\r\n')
+
+        with script.CsvSink(self.fn, ('a', 'b'), remove_if_empty=True):
+            pass
+        self.assertFalse(os.path.exists(self.fn))
+
+        # there is nothing to remove the second time ...
+        with script.CsvSink(self.fn, ('a', 'b'), remove_if_empty=True):
+            pass
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class ApproximateStatsTest(unittest.TestCase):
+    """ checks the ranks of the quantiles estimated by QuantileSketch are within its rank error, and the other
+        stats of a StatsAccumulator are exact - whether the values are added at once or merged from parts
+    """
+
+    ERROR = 0.01
+    QUANTILES = [x / 100.0 for x in range(1, 100)]
+
+    def get_values(self):
+        r = np.random.RandomState(3)
+        normal = r.normal(size=100000)
+        # random, sorted and heavily duplicated values ...
+        return [normal, np.sort(normal), r.randint(0, 50, 100000).astype(np.float64)]
+
+    def add(self, accumulator, values, batch_size=997):
+        for x in range(0, len(values), batch_size):
+            accumulator.update(values[x:x + batch_size])
+        return accumulator
+
+    def merged(self, cls, values, parts=4):
+        accumulators = [self.add(cls(self.ERROR), part) for part in np.array_split(values, parts)]
+        for accumulator in accumulators[1:]:
+            accumulators[0].merge(accumulator)
+        return accumulators[0]
+
+    def assertRankError(self, sketch, values):
+        values = np.sort(values)
+        for q, estimate in zip(self.QUANTILES, sketch.get_quantiles(self.QUANTILES)):
+            # the estimate may be any of a run of equal values ...
+            lo = np.searchsorted(values, estimate, 'left')
+            hi = np.searchsorted(values, estimate, 'right')
+            rank = min(max(q * (len(values) - 1), lo), hi)
+            self.assertLessEqual(abs(rank - q * (len(values) - 1)), self.ERROR * len(values), (q, estimate))
+
+        self.assertLessEqual(sum(len(level) for level in sketch.levels), 3 * sketch.k)
+
+    def test_exact_until_full(self):
+        values = np.random.RandomState(4).normal(size=100)
+        sketch = self.add(script.QuantileSketch(self.ERROR), values, 10)
+        self.assertEqual(list(sketch.get_quantiles(self.QUANTILES)),
+                         list(np.percentile(values, [q * 100 for q in self.QUANTILES])))
+
+    def test_rank_error(self):
+        for values in self.get_values():
+            self.assertRankError(self.add(script.QuantileSketch(self.ERROR), values), values)
+
+    def test_merged_rank_error(self):
+        for values in self.get_values():
+            self.assertRankError(self.merged(script.QuantileSketch, values), values)
+
+    def test_stats(self):
+        for values in self.get_values():
+            for accumulator in (self.add(script.StatsAccumulator(self.ERROR), values),
+                                self.merged(script.StatsAccumulator, values)):
+                count, mean, std, min_val, q1, q2, q3, max_val = accumulator.get_stats()
+                self.assertEqual(count, len(values))
+                self.assertAlmostEqual(mean, np.mean(values))
+                self.assertAlmostEqual(std, np.std(values))
+                self.assertEqual((min_val, max_val), (np.min(values), np.max(values)))
+                self.assertTrue(min_val <= q1 <= q2 <= q3 <= max_val)
+
+    def test_empty(self):
+        accumulator = script.StatsAccumulator(self.ERROR)
+        accumulator.merge(script.StatsAccumulator(self.ERROR))
+        self.assertEqual(accumulator.get_stats(), [0] + [''] * (len(script.STATS_FORMULAS) - 1))
+
+
+class ProjectingReaderTest(unittest.TestCase):
+    """ checks the projected columns of the rows read by ProjectingReader are those read by csv.reader """
+
+    COL_NUMS = [1, 3]
+    WIDTH = 6
+
+    def get_rows(self, seed, quoted, ragged=0.0):
+        r = random.Random(seed)
+        rows = [['h{0}'.format(x) for x in range(self.WIDTH)]]
+        for x in range(3000):
+            row = [str(r.randint(0, 1000)) for _ in range(self.WIDTH)]
+            if r.random() < quoted:
+                row[r.randrange(self.WIDTH)] = r.choice(('a, b', 'multi\nline', 'said "hi"', '"', ''))
+            if r.random() < ragged:
+                row = row[:r.randint(0, self.WIDTH - 1)]
+            rows.append(row)
+        return rows
+
+    def read(self, rows, width=0):
+        f = cStringIO.StringIO()
+        csv.writer(f, lineterminator='\n').writerows(rows)
+        f.seek(0)
+
+        reader = script.ProjectingReader(f)
+        self.assertEqual(next(reader), rows[0])
+        reader.project(self.COL_NUMS, width)
+        return list(reader), reader.ragged_rows
+
+    def assertProjected(self, rows, width=0):
+        projected, ragged_rows = self.read(rows, width)
+        self.assertEqual(len(projected), len(rows) - 1)
+
+        expected_ragged_rows = []
+        for x, (row, expected) in enumerate(zip(projected, rows[1:])):
+            if len(expected) < width:
+                expected_ragged_rows.append((x, len(expected)))
+                self.assertIsNone(row, x)
+            elif not expected:
+                # blank lines are read as empty rows, as by csv.reader ...
+                self.assertEqual(row, [], x)
+            else:
+                # only the fields up to the last projected column are split, the rest of the line is left as is ...
+                end = max(self.COL_NUMS) + 1
+                self.assertEqual(row[:end], expected[:end], x)
+        self.assertEqual(ragged_rows, expected_ragged_rows)
+
+    def test_projected(self):
+        for quoted in (0.0, 0.05, 0.3):
+            self.assertProjected(self.get_rows(1, quoted))
+
+    def test_mostly_quoted(self):
+        # once most lines have quotes, the rest of the file is read by the csv module alone ...
+        with patched(MIN_QUOTED_LINES=10):
+            self.assertProjected(self.get_rows(2, 0.9))
+            self.assertProjected(self.get_rows(3, 0.9, ragged=0.05), self.WIDTH)
+
+    def test_ragged_rows(self):
+        for quoted in (0.0, 0.05, 0.3):
+            self.assertProjected(self.get_rows(4, quoted, ragged=0.05), self.WIDTH)
+
+
+class ServerTest(unittest.TestCase):
+    """ checks the jobs answered by an AnalysisServer over http have the results of the same analysis run by the App,
+        and that invalid jobs are answered with errors
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp(prefix='csv-analysis-test-')
+        cls.csv_path = os.path.join(cls.path, 'csv')
+        os.mkdir(cls.csv_path)
+        write_fixture(os.path.join(cls.csv_path, 'test_001_g1_.csv'), HEADERS, 1)
+        write_fixture(os.path.join(cls.csv_path, 'test_002_g1_.csv'), [h for h in HEADERS if h != 'dbSNP'], 2)
+
+        cls.filters = '\n'.join(FILTERS)
+        cls.filter_file_path = os.path.join(cls.path, 'filters.csv')
+        with open(cls.filter_file_path, 'w') as f:
+            f.write(cls.filters)
+
+        cls.server = script.ThreadingHTTPServer(('127.0.0.1', 0), script.AnalysisRequestHandler)
+        cls.server.analysis_server = script.AnalysisServer(get_app(cls.csv_path, cls.filter_file_path, cls.path))
+        cls.server.quiet = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+        shutil.rmtree(cls.path, ignore_errors=True)
+
+    def request(self, method, path, body=None):
+        """ returns the status and json response of a request to the server """
+
+        connection = httplib.HTTPConnection(*self.server.server_address)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def read_csv(self, path):
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            return list(csv.reader(f))
+
+    def to_csv(self, header, rows):
+        """ returns the rows of a json response as they would be read back from a csv file """
+
+        f = cStringIO.StringIO()
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+        f.seek(0)
+        return list(csv.reader(f))
+
+    def assertResults(self, results, csv_path, name):
+        out_path = os.path.join(self.path, name)
+        os.mkdir(out_path)
+        app = get_app(csv_path, self.filter_file_path, out_path)
+        app._scan_for_csvs()
+        app._scan_for_filters()
+        app._do_combined_analysis()
+
+        results_path, stats_path = app._get_out_file_paths(script.ANALYSIS_TYPE_COMBINED)
+        self.assertEqual(self.to_csv(results['header'], results['rows']), self.read_csv(results_path))
+        self.assertEqual(self.to_csv(results['stats_header'], results['stats_rows']), self.read_csv(stats_path))
+        self.assertEqual(self.to_csv(results['error_header'], results['errors']),
+                         self.read_csv(app.error_log_file_path))
+        self.assertTrue(results['errors'])
+
+    def test_results(self):
+        status, results = self.request('POST', '/combined', json.dumps({'filters': self.filters}))
+        self.assertEqual(status, 200)
+        self.assertFalse(results['reused'])
+        self.assertResults(results, self.csv_path, 'results')
+
+        # an identical job is answered from the recent results ...
+        status, reused = self.request('POST', '/combined', json.dumps({'filters': self.filters}))
+        self.assertEqual(status, 200)
+        self.assertTrue(reused.pop('reused'))
+        results.pop('reused')
+        self.assertEqual(reused, results)
+
+        status, server_status = self.request('GET', '/status')
+        self.assertEqual(status, 200)
+        self.assertGreaterEqual(server_status['results_reused'], 1)
+
+    def test_changed_file(self):
+        csv_path = os.path.join(self.path, 'changed')
+        shutil.copytree(self.csv_path, csv_path)
+        job = json.dumps({'filters': self.filters, 'csv_dir': csv_path})
+        self.assertEqual(self.request('POST', '/combined', job)[0], 200)
+
+        # a changed csv file is analysed again, rather than answered from the recent results ...
+        fn = os.path.join(csv_path, 'test_001_g1_.csv')
+        write_fixture(fn, HEADERS, 5)
+        os.utime(fn, (0, 0))
+        status, results = self.request('POST', '/combined', job)
+        self.assertEqual(status, 200)
+        self.assertFalse(results['reused'])
+        self.assertResults(results, csv_path, 'changed_results')
+
+    def test_errors(self):
+        job = json.dumps({'filters': self.filters})
+        for method, path, body, expected_status in (
+                ('POST', '/unknown', job, 404),
+                ('GET', '/unknown', None, 404),
+                ('POST', '/count', 'not json', 400),
+                ('POST', '/count', json.dumps(['not', 'an', 'object']), 400),
+                ('POST', '/count', json.dumps({}), 400),
+                ('POST', '/count', json.dumps({'filters': 'Count,>=abc'}), 400),
+                ('POST', '/count', json.dumps({'filters': ''}), 400),
+                ('POST', '/count', json.dumps({'filters': self.filters, 'csv_dir': os.path.join(self.path, 'missing')}),
+                 400),
+                ('POST', '/stats', json.dumps({'filters': self.filters, 'approximate_stats': 2}), 400)):
+            status, response = self.request(method, path, body)
+            self.assertEqual(status, expected_status, (method, path, body))
+            self.assertIn('error', response)
+
+
+class FakeClock(object):
+    """ stands in for the time module of the script - each sleep advances the time returned by time(), and then
+        calls the next of a list of steps, raising KeyboardInterrupt once they have all been called
+    """
+
+    def __init__(self, steps):
+        self.now = 0.0
+        self.steps = list(steps)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if not self.steps:
+            raise KeyboardInterrupt()
+        self.steps.pop(0)()
+
+
+class WatchTest(unittest.TestCase):
+    """ checks the results updated by watch mode, as csv files are added, removed and changed, are those of analysing
+        the complete csv files from scratch
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='csv-analysis-test-')
+        self.csv_path = os.path.join(self.path, 'csv')
+        os.mkdir(self.csv_path)
+        self.write_csv(1)
+        self.write_csv(2)
+        self.write_filters(FILTERS, 1)
+
+        self.app = get_app(self.csv_path, self.filter_file_path, os.path.join(self.path, 'watch'))
+        os.mkdir(os.path.join(self.path, 'watch'))
+        self.app.incremental = True
+        self.app._scan_for_csvs()
+        self.app._scan_for_filters()
+        self.app._do_analysis(script.ANALYSIS_TYPE_COUNT)
+
+        self.log = []
+        self.errors = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write_csv(self, num):
+        write_fixture(os.path.join(self.csv_path, 'test_{0:03d}_g1_.csv'.format(num)), HEADERS, num)
+
+    def write_filters(self, filters, mtime):
+        self.filter_file_path = os.path.join(self.path, 'filters.csv')
+        with open(self.filter_file_path, 'w') as f:
+            f.write('\n'.join(filters))
+        # distinct mtimes, however quickly the file is rewritten ...
+        os.utime(self.filter_file_path, (mtime, mtime))
+
+    def get_results(self, app):
+        contents = []
+        for path in (app.out_file_path, app.error_log_file_path):
+            with open(path, 'rb') as f:
+                contents.append(f.read())
+        return contents
+
+    def analyse(self):
+        """ returns the results and error log of a count analysis of the csv files from scratch """
+
+        out_path = tempfile.mkdtemp(dir=self.path)
+        app = get_app(self.csv_path, self.filter_file_path, out_path)
+        app._scan_for_csvs()
+        app._scan_for_filters()
+        app._do_analysis(script.ANALYSIS_TYPE_COUNT)
+        return self.get_results(app)
+
+    def watch(self, *steps):
+        with patched(time=FakeClock(steps)):
+            with self.assertRaises(KeyboardInterrupt):
+                self.app._watch(script.ANALYSIS_TYPE_COUNT, 1, 2, self.log.append, self.errors.append)
+
+    def test_watch(self):
+        expected = {}
+
+        def check(name):
+            self.assertEqual(self.get_results(self.app), expected[name], name)
+
+        def add():
+            self.write_csv(3)
+            expected['added'] = self.analyse()
+
+        def remove_and_write():
+            # the new file is still being written, so is left out until it has gone unchanged for settle_time ...
+            os.remove(os.path.join(self.csv_path, 'test_002_g1_.csv'))
+            expected['removed'] = self.analyse()
+            self.write_csv(4)
+            expected['written'] = self.analyse()
+
+        def change_filters():
+            self.write_filters(FILTERS[:3], 2)
+            expected['filters'] = self.analyse()
+
+        self.watch(add,
+                   lambda: None,
+                   lambda: None,
+                   # analysed once the new file has gone unchanged for 2 seconds ...
+                   lambda: check('added'),
+                   remove_and_write,
+                   lambda: check('removed'),
+                   lambda: None,
+                   lambda: check('written'),
+                   change_filters,
+                   lambda: check('filters'))
+
+        # (without the time, and the number of errors) ...
+        messages = [msg.split(': ', 1)[1].rsplit(' (', 1)[0] for msg in self.log if not msg.startswith(' ')]
+        self.assertEqual(messages, ['analysed 1 new or changed file',
+                                    'analysed 0 new or changed files, removed 1 - waiting for 1 file to be complete',
+                                    'analysed 1 new or changed file',
+                                    'analysed 0 new or changed files, with the updated filters'])
+        self.assertEqual([msg for msg in self.log if msg.startswith(' ')], [' test_003_g1_.csv', ' test_004_g1_.csv'])
+        self.assertEqual(self.errors, [])
+
+    def test_errors(self):
+        moved_path = self.csv_path + '_moved'
+
+        def break_filters():
+            self.write_filters(['Count,>=abc'], 2)
+
+        def move():
+            os.rename(self.csv_path, moved_path)
+
+        def fix():
+            os.rename(moved_path, self.csv_path)
+            self.write_filters(FILTERS, 3)
+
+        # an error is only logged once, however many checks find it, and the results are updated once fixed ...
+        self.watch(break_filters, move, lambda: None, lambda: None, fix, lambda: None)
+        self.assertEqual(self.errors, ['the filters could not be loaded from {0}'.format(self.filter_file_path),
+                                       'CSV folder not found: {0}'.format(self.csv_path)])
+        self.assertEqual(len(self.log), 1)
+        self.assertEqual(self.get_results(self.app), self.analyse())
+
+
+if __name__ == '__main__':
+    unittest.main()